@@ -0,0 +1,323 @@
+# bench
+# Воспроизводимые измерения протокола на одной машине без сети: сервер и эмуляторы каналов (link.py)
+# работают в отдельных процессах, клиенты — в текущем. Отчёт — метрики по сценариям в JSON,
+# который можно сохранить как базовый и сравнивать с ним следующие измерения
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import statistics
+import tempfile
+import time
+
+from client import AggregatedClient
+from server import AggregatedServer, run_workers
+from .link import run_links
+from .scenarios import SCENARIOS
+
+REPORT_VERSION = 1
+GIB = 1 << 30
+SCENARIO_DEFAULTS = {
+    'payload': 1 << 20, 'data': 'random', 'transfers': 1, 'concurrency': 1, 'shared_client': True, 'client': {},
+    'server': {},
+    'timeout': 120.0,
+}
+# Метрики, по которым отчёт сравнивается с базовым: 1 — чем больше, тем лучше, -1 — чем меньше
+COMPARED_METRICS = {
+    'throughput_mib_s': 1,
+    'latency_p95_s': -1,
+    'cpu_client_s_per_gib': -1,
+    'cpu_server_s_per_gib': -1,
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    # Перцентиль по ближайшему рангу
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def make_payload(kind, size, seed=0):
+    # 'random' — несжимаемые данные, 'text' — журнал в формате JSON Lines (сжимается в несколько раз)
+    if kind == 'random':
+        return os.urandom(size)
+    if kind != 'text':
+        raise ValueError(f"Неизвестный вид данных: {kind}")
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        line = json.dumps({
+            'time': 1700000000 + length, 'level': rng.choice(('INFO', 'INFO', 'WARNING', 'ERROR')),
+            'channel': f'Channel{rng.randrange(1, 3)}', 'segment': rng.randrange(1 << 20),
+            'message': rng.choice(('сегмент сохранён', 'повтор сегмента', 'сессия открыта')),
+        }, ensure_ascii=False).encode() + b'\n'
+        lines.append(line)
+        length += len(line)
+    return b''.join(lines)[:size]
+
+
+def process_tree_cpu(pid):
+    # Время процессора (user + system, сек) процесса и всех его потомков по /proc: учитываются
+    # рабочие процессы сервера и завершённые потомки, которых дождался родитель
+    processes = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # Процесс уже завершился
+        # После имени процесса: состояние, ppid, ..., utime и stime (поля 14 и 15), cutime и cstime
+        processes[int(entry)] = (int(fields[1]), sum(int(value) for value in fields[11:15]))
+    children = {}
+    for child, (parent, _) in processes.items():
+        children.setdefault(parent, []).append(child)
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += processes.get(current, (0, 0))[1]
+        stack.extend(children.get(current, ()))
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def own_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def serve(channels, storage_dir, options):
+    # Точка входа процесса сервера; останавливается сигналом SIGINT
+    logging.disable(logging.INFO)
+    options = dict(options)
+    workers = options.pop('workers', 1)
+    try:
+        if workers > 1:
+            run_workers(channels, workers, storage_dir=storage_dir, **options)
+        else:
+            asyncio.run(AggregatedServer(channels, storage_dir=storage_dir, **options).start_servers())
+    except KeyboardInterrupt:
+        pass
+
+
+async def wait_ports(ports, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    for port in ports:
+        while True:
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+
+async def run_transfers(scenario, channels, payload):
+    # Передачи сценария; возвращает (длительности, идентификаторы сессий, число ошибок, повторы, время)
+    limit = asyncio.Semaphore(scenario['concurrency'])
+    server_address = ('127.0.0.1', channels[0]['port'])
+    shared = AggregatedClient(server_address, channels, **scenario['client']) if scenario['shared_client'] else None
+    durations, session_ids = [], []
+    stats = {'failed': 0, 'retransmitted': 0}
+
+    async def transfer():
+        async with limit:
+            start = time.monotonic()
+            try:
+                if shared is not None:
+                    session_id = await shared.send_data(payload)
+                else:
+                    async with AggregatedClient(server_address, channels, **scenario['client']) as client:
+                        session_id = await client.send_data(payload)
+                    stats['retransmitted'] += client.metrics.value('segments_retransmitted')
+            except Exception as e:
+                logging.warning(f"Передача не выполнена: {e}")
+                stats['failed'] += 1
+                return
+            durations.append(time.monotonic() - start)
+            session_ids.append(session_id)
+
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(transfer()) for _ in range(scenario['transfers'])]
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), scenario['timeout'])
+    except asyncio.TimeoutError:
+        logging.warning(f"Сценарий не уложился в {scenario['timeout']} сек")
+    finally:
+        elapsed = time.monotonic() - start
+        if shared is not None:
+            stats['retransmitted'] += shared.metrics.value('segments_retransmitted')
+            await shared.close()
+    return durations, session_ids, stats['failed'], stats['retransmitted'], elapsed
+
+
+def verify_transfers(storage_dir, session_ids, payload, timeout=5.0):
+    # Сервер завершает сессию после ответа на FIN: файл может появиться чуть позже
+    digest = hashlib.sha256(payload).digest()
+    deadline = time.monotonic() + timeout
+    verified = 0
+    for session_id in session_ids:
+        path = os.path.join(storage_dir, f'session_{session_id}.dat')
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        try:
+            with open(path, 'rb') as received:
+                verified += hashlib.sha256(received.read()).digest() == digest
+        except FileNotFoundError:
+            pass
+    return verified
+
+
+def run_scenario(scenario, seed=0):
+    scenario = dict(SCENARIO_DEFAULTS, **scenario)
+    links = scenario['links']
+    server_channels = [
+        {'name': f'Channel{i + 1}', 'host': '127.0.0.1', 'port': free_port()} for i in range(len(links))
+    ]
+    client_channels = [dict(channel, port=free_port()) for channel in server_channels]
+    payload = make_payload(scenario['data'], scenario['payload'], seed)
+    # spawn: дочерние процессы не наследуют потоки исполнителей и состояние клиентов текущего процесса
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='bench_') as storage_dir:
+        server = context.Process(target=serve, args=(server_channels, storage_dir, scenario['server']))
+        connection, child_connection = context.Pipe()
+        emulator = context.Process(target=run_links, args=(
+            [(client['port'], (server_channel['host'], server_channel['port']), link)
+             for client, server_channel, link in zip(client_channels, server_channels, links)],
+            child_connection, seed))
+        server.start()
+        emulator.start()
+        link_stats = []
+        try:
+            if not connection.poll(30) or connection.recv() != 'ready':
+                raise RuntimeError('эмулятор каналов не запустился')
+            asyncio.run(wait_ports([channel['port'] for channel in server_channels]))
+            cpu_before = own_cpu(), process_tree_cpu(server.pid), process_tree_cpu(emulator.pid)
+            durations, session_ids, failed, retransmitted, elapsed = asyncio.run(
+                run_transfers(scenario, client_channels, payload))
+            cpu_client = own_cpu() - cpu_before[0]
+            cpu_server = process_tree_cpu(server.pid) - cpu_before[1]
+            cpu_emulator = process_tree_cpu(emulator.pid) - cpu_before[2]
+            connection.send('stop')
+            if connection.poll(10):
+                link_stats = connection.recv()
+        finally:
+            emulator.join(10)
+            if emulator.is_alive():
+                emulator.terminate()
+            os.kill(server.pid, signal.SIGINT)
+            server.join(10)
+            if server.is_alive():
+                server.terminate()
+                server.join()
+        verified = verify_transfers(storage_dir, session_ids, payload)
+
+    transferred = verified * len(payload)
+    return {
+        'transfers': scenario['transfers'],
+        'completed': verified,
+        'errors': scenario['transfers'] - verified,  # Отказы, таймауты и данные, не совпавшие с отправленными
+        'failed': failed,
+        'payload_bytes': len(payload),
+        'wall_s': elapsed,
+        'throughput_mib_s': transferred / (1 << 20) / elapsed if elapsed else None,
+        'latency_p50_s': percentile(durations, 0.50),
+        'latency_p95_s': percentile(durations, 0.95),
+        'latency_p99_s': percentile(durations, 0.99),
+        'retransmitted_segments': retransmitted,
+        'link_stalls': sum(stats['stalls'] for stats in link_stats),
+        'link_bytes': sum(stats['bytes'] for stats in link_stats),  # Байты в обоих направлениях всех каналов
+        'cpu_client_s': cpu_client,
+        'cpu_server_s': cpu_server,
+        'cpu_emulator_s': cpu_emulator,
+        'cpu_client_s_per_gib': cpu_client * GIB / transferred if transferred else None,
+        'cpu_server_s_per_gib': cpu_server * GIB / transferred if transferred else None,
+    }
+
+
+def median_metrics(runs):
+    # Повторные прогоны сценария сводятся медианой каждой метрики
+    result = {}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs]
+        result[metric] = None if None in values else statistics.median(values)
+    return result
+
+
+def run_benchmark(names=None, scenarios=None, repeat=1, seed=0):
+    scenarios = SCENARIOS if scenarios is None else scenarios
+    names = names or list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        raise ValueError(f"Неизвестные сценарии: {', '.join(unknown)}")
+    report = {
+        'version': REPORT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': {'python': platform.python_version(), 'system': platform.platform(), 'cpus': os.cpu_count()},
+        'repeat': repeat,
+        'scenarios': {},
+    }
+    for name in names:
+        logging.warning(f"Сценарий {name}")
+        runs = [run_scenario(scenarios[name], seed + run) for run in range(repeat)]
+        report['scenarios'][name] = median_metrics(runs)
+    return report
+
+
+def compare_reports(report, baseline, tolerance=0.1):
+    # Регрессии относительно базового отчёта: метрика ухудшилась больше чем на tolerance (доля)
+    # или появились ошибки передачи. Сценарии, которых нет в базовом отчёте, не сравниваются
+    regressions = []
+    for name, metrics in report['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        if metrics['errors'] > base.get('errors', 0):
+            regressions.append({'scenario': name, 'metric': 'errors', 'baseline': base.get('errors', 0),
+                                'value': metrics['errors'], 'change': None})
+        for metric, direction in COMPARED_METRICS.items():
+            old, new = base.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if change * direction < -tolerance:
+                regressions.append({'scenario': name, 'metric': metric, 'baseline': old, 'value': new,
+                                    'change': change})
+    return regressions
+
+
+def format_report(report):
+    columns = [
+        ('сценарий', None), ('МиБ/с', 'throughput_mib_s'), ('p50, с', 'latency_p50_s'),
+        ('p95, с', 'latency_p95_s'), ('p99, с', 'latency_p99_s'), ('повторы', 'retransmitted_segments'),
+        ('ошибки', 'errors'), ('CPU кл., с/ГиБ', 'cpu_client_s_per_gib'), ('CPU серв., с/ГиБ', 'cpu_server_s_per_gib'),
+    ]
+    rows = [[title for title, _ in columns]]
+    for name, metrics in report['scenarios'].items():
+        row = [name]
+        for _, metric in columns[1:]:
+            value = metrics[metric]
+            row.append('-' if value is None else f'{value:.3f}' if isinstance(value, float) else str(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
@@ -0,0 +1,53 @@
+# python -m bench [-s сценарий ...] [-o отчёт.json] [--baseline базовый.json]
+import argparse
+import json
+import logging
+import sys
+
+from . import compare_reports, format_report, run_benchmark
+from .scenarios import SCENARIOS
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Измерения протокола через эмулятор каналов')
+    parser.add_argument('-s', '--scenario', action='append', help='сценарий (по умолчанию все)')
+    parser.add_argument('--scenarios', help='JSON-файл со сценариями вместо встроенных (см. bench/scenarios.py)')
+    parser.add_argument('--list', action='store_true', help='вывести сценарии и выйти')
+    parser.add_argument('--repeat', type=int, default=1, help='прогонов каждого сценария (метрики — медиана)')
+    parser.add_argument('--seed', type=int, default=0, help='начальное значение генератора потерь и джиттера')
+    parser.add_argument('-o', '--output', help='файл для отчёта в JSON')
+    parser.add_argument('--baseline', help='базовый отчёт для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='допустимое ухудшение метрики (доля)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)  # Журнал каждого сегмента искажает измерения
+
+    scenarios = SCENARIOS
+    if args.scenarios:
+        with open(args.scenarios) as f:
+            scenarios = json.load(f)
+    if args.list:
+        for name, scenario in scenarios.items():
+            print(name, json.dumps(scenario, ensure_ascii=False))
+        return 0
+
+    report = run_benchmark(args.scenario, scenarios, args.repeat, args.seed)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            change = '' if regression['change'] is None else f" ({regression['change']:+.1%})"
+            print(f"Регрессия {regression['scenario']}: {regression['metric']} "
+                  f"{regression['baseline']} -> {regression['value']}{change}")
+        if regressions:
+            return 1
+        print('Регрессий относительно базового отчёта нет')
+    return 0
+
+
+# Процессы сервера и эмулятора запускаются через spawn и импортируют этот модуль заново
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# link.py
+# Эмулятор канала: TCP-прокси между клиентом и портом сервера, добавляющий задержку, джиттер,
+# ограничение скорости и потери. Каждое направление соединения эмулируется независимо
+import asyncio
+import collections
+import logging
+import math
+import random
+import time
+
+CHUNK_SIZE = 16 * 1024  # Порция пересылки: чем меньше, тем ровнее ограничение скорости
+PACKET_SIZE = 1448  # Полезная нагрузка TCP-пакета: вероятность потери задаётся на пакет
+
+# Параметры канала по умолчанию: задержка и джиттер в секундах, скорость в байт/сек (0 — без ограничения),
+# вероятность потери пакета, время восстановления после потери (None — 3 задержки, не меньше 10 мс)
+# и объём данных в пути (None — удвоенное произведение скорости на задержку, не меньше 256 КиБ)
+DEFAULT_LINK = {'delay': 0.0, 'jitter': 0.0, 'bandwidth': 0, 'loss': 0.0, 'rto': None, 'buffer': None}
+
+
+def link_profile(link):
+    profile = dict(DEFAULT_LINK, **link)
+    if profile['rto'] is None:
+        profile['rto'] = max(3 * profile['delay'], 0.01)
+    if profile['buffer'] is None:
+        profile['buffer'] = max(256 * 1024, int(2 * profile['bandwidth'] * (profile['delay'] + profile['jitter'])))
+    return profile
+
+
+class LinkDirection:
+    # Одно направление соединения: порции доставляются по порядку (TCP не переупорядочивает данные),
+    # каждая — после передачи на заданной скорости, задержки с джиттером и, если пакет потерян,
+    # паузы на повторную передачу, которая задерживает и все следующие порции
+    def __init__(self, profile, rng, stats):
+        self.profile = profile
+        self.rng = rng
+        self.stats = stats  # Общие счётчики эмулятора
+        self.queue = collections.deque()  # (время доставки, порция); None — конец потока
+        self.queued_bytes = 0
+        self.free_at = 0.0  # Когда канал закончит передавать уже поставленные порции
+        self.last_delivery = 0.0
+        self.arrived = asyncio.Event()  # В очереди появилась порция
+        self.space = asyncio.Event()  # В буфере канала освободилось место
+
+    def schedule(self, chunk):
+        profile = self.profile
+        now = time.monotonic()
+        start = max(now, self.free_at)
+        self.free_at = start + (len(chunk) / profile['bandwidth'] if profile['bandwidth'] else 0.0)
+        deliver_at = self.free_at + profile['delay'] + self.rng.uniform(0.0, profile['jitter'])
+        if profile['loss']:
+            packets = math.ceil(len(chunk) / PACKET_SIZE)
+            if self.rng.random() < 1.0 - (1.0 - profile['loss']) ** packets:
+                deliver_at += profile['rto']  # Потерянный пакет передаётся повторно
+                self.stats['stalls'] += 1
+        self.last_delivery = max(deliver_at, self.last_delivery)
+        self.queue.append((self.last_delivery, chunk))
+        self.queued_bytes += len(chunk)
+        self.stats['bytes'] += len(chunk)
+        self.arrived.set()
+
+    async def receive(self, reader):
+        try:
+            while True:
+                while self.queued_bytes >= self.profile['buffer']:
+                    # Данные в пути не помещаются в буфер канала: отправитель ждёт, как при заполненном окне TCP
+                    self.space.clear()
+                    await self.space.wait()
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.schedule(chunk)
+        except (ConnectionError, OSError):
+            pass
+        self.queue.append((self.last_delivery, None))
+        self.arrived.set()
+
+    async def deliver(self, writer):
+        while True:
+            while not self.queue:
+                self.arrived.clear()
+                await self.arrived.wait()
+            deliver_at, chunk = self.queue[0]
+            wait = deliver_at - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.queue.popleft()
+            if chunk is None:
+                if writer.can_write_eof():
+                    writer.write_eof()
+                return
+            self.queued_bytes -= len(chunk)
+            self.space.set()
+            writer.write(chunk)
+            await writer.drain()
+
+
+class LinkEmulator:
+    def __init__(self, listen_port, target, link, seed=0):
+        self.listen_port = listen_port  # Порт, к которому подключается клиент
+        self.target = target  # (хост, порт) канала сервера
+        self.profile = link_profile(link)
+        self.rng = random.Random(seed)  # Потери и джиттер воспроизводимы при одинаковом seed
+        self.stats = {'bytes': 0, 'stalls': 0, 'connections': 0}
+        self.server = None
+        self.writers = set()  # Открытые соединения: закрываются при остановке эмулятора
+        self.handlers = set()  # Задачи обработчиков соединений: отменяются и дожидаются при остановке
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, '127.0.0.1', self.listen_port)
+
+    async def handle_connection(self, client_reader, client_writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        try:
+            await self.relay(client_reader, client_writer)
+        finally:
+            self.handlers.discard(handler)
+
+    async def relay(self, client_reader, client_writer):
+        self.stats['connections'] += 1
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError as e:
+            logging.error(f"[Эмулятор {self.listen_port}] Сервер недоступен: {e}")
+            client_writer.close()
+            return
+        self.writers.update((client_writer, server_writer))
+        upstream = LinkDirection(self.profile, self.rng, self.stats)
+        downstream = LinkDirection(self.profile, self.rng, self.stats)
+        pumps = [
+            asyncio.create_task(upstream.receive(client_reader)),
+            asyncio.create_task(upstream.deliver(server_writer)),
+            asyncio.create_task(downstream.receive(server_reader)),
+            asyncio.create_task(downstream.deliver(client_writer)),
+        ]
+        try:
+            await asyncio.gather(*pumps)
+        except (ConnectionError, OSError):
+            pass  # Одна из сторон разорвала соединение
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+            for writer in (client_writer, server_writer):
+                writer.close()
+                self.writers.discard(writer)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        # Обработчики завершаются до остановки цикла событий, иначе их отмена при выходе
+        # печатает трассировки CancelledError
+        handlers = list(self.handlers)
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+
+def run_links(links, connection, seed=0):
+    # Точка входа процесса эмулятора: links — список (порт клиента, (хост, порт) сервера, параметры канала).
+    # Процесс сообщает о готовности, а по команде остановки возвращает счётчики каналов
+    logging.disable(logging.INFO)
+
+    async def main():
+        emulators = [LinkEmulator(port, target, link, seed + i) for i, (port, target, link) in enumerate(links)]
+        for emulator in emulators:
+            await emulator.start()
+        connection.send('ready')
+        await asyncio.get_running_loop().run_in_executor(None, connection.recv)  # Команда остановки
+        for emulator in emulators:
+            await emulator.close()
+        connection.send([emulator.stats for emulator in emulators])
+
+    asyncio.run(main())
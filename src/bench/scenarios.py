@@ -0,0 +1,37 @@
+# scenarios.py
+# Сценарии измерений по умолчанию. Сценарий — словарь:
+#   links       — параметры каналов (см. link.DEFAULT_LINK), по одному эмулятору и порту сервера на канал
+#   payload     — размер одной передачи в байтах, data — вид данных: 'random' или 'text' (сжимаемый журнал)
+#   transfers   — число передач, concurrency — сколько из них идут одновременно
+#   shared_client — передачи ведутся сессиями одного AggregatedClient (иначе у каждой свой клиент)
+#   client, server — параметры AggregatedClient и AggregatedServer (у сервера также workers)
+#   timeout     — ограничение времени сценария в секундах
+# Пары сценариев с одним и двумя каналами показывают, даёт ли агрегация прирост
+MB = 1 << 20
+
+FAST = {'delay': 0.005, 'bandwidth': 8 * MB}
+SLOW = {'delay': 0.04, 'jitter': 0.005, 'bandwidth': 2 * MB}
+MEDIUM = {'delay': 0.01, 'bandwidth': 4 * MB}
+
+SCENARIOS = {
+    # Без эмуляции ограничений: затраты процессора клиента и сервера на гигабайт
+    'loopback': {'links': [{}, {}], 'payload': 16 * MB, 'transfers': 3},
+    'single': {'links': [MEDIUM], 'payload': 4 * MB, 'transfers': 3},
+    'symmetric': {'links': [MEDIUM, MEDIUM], 'payload': 4 * MB, 'transfers': 3},
+    'asymmetric_fast_only': {'links': [FAST], 'payload': 4 * MB, 'transfers': 3},
+    'asymmetric': {'links': [FAST, SLOW], 'payload': 4 * MB, 'transfers': 3},
+    'asymmetric_ecf': {'links': [FAST, SLOW], 'payload': 4 * MB, 'transfers': 3, 'client': {'scheduler': 'ecf'}},
+    'lossy': {'links': [dict(MEDIUM, loss=0.01), dict(MEDIUM, loss=0.01)], 'payload': 4 * MB, 'transfers': 3},
+    # Сжимаемые данные по медленным каналам: сжатие перед шифрованием уменьшает объём в каналах
+    'text_slow': {'links': [SLOW, SLOW], 'data': 'text', 'payload': 4 * MB, 'transfers': 2},
+    'text_slow_zlib': {
+        'links': [SLOW, SLOW], 'data': 'text', 'payload': 4 * MB, 'transfers': 2, 'client': {'compression': 'zlib'},
+    },
+    # Несжимаемые данные: выборка энтропии пропускает сжатие, затраты процессора почти не растут
+    'symmetric_zlib': {'links': [MEDIUM, MEDIUM], 'payload': 4 * MB, 'transfers': 3, 'client': {'compression': 'zlib'}},
+    # Множество коротких передач: задержка открытия и завершения сессий
+    'many_small': {'links': [FAST, FAST], 'payload': 2048, 'transfers': 200, 'concurrency': 50},
+    'many_small_separate_clients': {
+        'links': [FAST, FAST], 'payload': 2048, 'transfers': 200, 'concurrency': 50, 'shared_client': False,
+    },
+}
@@ -1,153 +1,633 @@
 # client.py
 import asyncio
-import hashlib
-import struct
+import collections
+import math
+import os
 import time
 import random
 import logging
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
+from concurrent.futures import ProcessPoolExecutor
 from Crypto.Random import get_random_bytes
 
+from protocol import (
+    ACK, CIPHER_CTR, CIPHER_GCM, CODE_FIN, CODE_KEY, CODE_V2_DATA, CODE_WINDOWED_SEGMENT, COMPRESSION_VERSION, DATA_LENGTH,
+    FLAG_PARITY, FRAME_HEADER, KEY_ACCEPTED, NACK, OPTION_CIPHER, OPTION_COMPRESSION, OPTION_FEC_BLOCK, OPTION_SEGMENT_SIZE,
+    OPTION_TOTAL_SEGMENTS, OPTION_VERSION, PROTOCOL_VERSION, SESSION_BUSY, SESSION_TOO_LARGE, V2_ACK_CODE, V2_BUSY_CODE,
+    V2_ENTRY, V2_FRAME_TAIL, V2_TOTAL, WINDOWED_ACK_OK,
+    WINDOWED_SEGMENT_HEADER, encode_key_options, read_key_reply, read_v2_reply, read_windowed_reply,
+)
+from protocol.compression import CHUNK_STORED, CODECS, COMPRESSION_CHUNK_SIZE, compress_chunks
+from protocol.crypto import CHECKSUM_SHA256, CHECKSUM_TAG, create_executor, encrypt_segments, run_in_executor
+from protocol.fec import encode_parity
+from protocol.metrics import Metrics, serve_metrics
+from .pool import ChannelPool
+from .scheduler import ChannelEstimator, create_scheduler
+from .session import ClientSession, FairWindow
+
 logging.basicConfig(level=logging.INFO)  # Настройка уровня логирования
 
+COMPRESSION_AHEAD = 4  # Сколько порций потока сжимается одновременно
+
 class AggregatedClient:
-    def __init__(self, server_address, channels):
+    def __init__(self, server_address, channels, pool_size=2, window_size=8, scheduler='wrr',
+                 protocol_version=PROTOCOL_VERSION, batch_size=16, aead=False, crypto_executor='thread',
+                 crypto_workers=None, fec_block=0, trace_rate=0.0, log_segments=False, compression=None,
+                 compression_level=None):
         self.server_address = server_address  # Адрес сервера
         self.channels = channels  # Список каналов
-        self.session_id = int(time.time())  # Уникальный идентификатор сессии
-        self.segment_size = 1024  # Размер сегмента в байтах
-        # Состояние каналов: задержка и пропускная способность
-        self.channel_states = {ch['name']: {'latency': 0.0, 'bandwidth': 0.0} for ch in channels}
+        # Клиент может вести несколько передач одновременно (send_data, send_file и send_stream
+        # в разных задачах): у каждой своя сессия (ClientSession), а соединения, окна каналов
+        # и оценки их пропускной способности общие
+        self.session_id = None  # Идентификатор последней открытой сессии
+        self.segment_size = 1024  # Размер сегмента в байтах (кратен блоку AES)
+        # Планировщик распределяет сегменты по всем каналам пропорционально EWMA-оценкам
+        # их пропускной способности: 'wrr', 'drr', 'ecf' или готовый экземпляр Scheduler
+        self.scheduler = create_scheduler(scheduler, channels, ChannelEstimator(channels))
+        self.estimator = self.scheduler.estimator
+        # Состояние каналов: сглаженные задержка и пропускная способность
+        self.channel_states = self.estimator.states
         self.retransmission_limit = 3  # Максимальное количество повторных попыток отправки
-        self.encryption_key = get_random_bytes(16)  # Симметричный ключ AES
+        # Попытки открыть сессию и начальная пауза между ними, если сервер перегружен
+        self.admission_attempts = 5
+        self.busy_backoff = 0.1
+        # Версия протокола, предлагаемая серверу в KEY (согласованная хранится в сессии)
+        self.protocol_version = protocol_version
+        # Сколько подряд идущих сегментов v2 упаковывается в один кадр
+        self.batch_size = batch_size
+        # Упреждающая коррекция ошибок (v3): сегмент чётности на каждые fec_block сегментов
+        # (накладные расходы 1/fec_block трафика), 0 — выключена
+        if fec_block and batch_size % fec_block:
+            raise ValueError('batch_size должен быть кратен fec_block')
+        self.fec_block = fec_block
+        # Окно: сколько неподтверждённых кадров всех сессий может одновременно находиться в каждом канале.
+        # Места окна сессии получают по очереди
+        self.window_size = window_size
+        self.windows = {ch['name']: FairWindow(window_size) for ch in channels}
+        # Очередь пачек зашифрованных сегментов между чтением потока и отправкой ограничена,
+        # поэтому память клиента не зависит от размера передаваемых данных
+        self.queue_size = window_size * len(channels)
+        # AES-GCM вместо AES-CTR с тегом BLAKE2b: шифрование и проверка целостности за один проход
+        self.cipher = CIPHER_GCM if aead else CIPHER_CTR
+        # Сжатие открытых данных перед шифрованием: 'zlib', 'lzma' или None; compression_level — уровень
+        # алгоритма (None — по умолчанию). Порции, похожие на случайные данные, передаются без сжатия.
+        # Сервер узнаёт алгоритм из KEY; сервер версии ниже 4 получит данные без сжатия
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"Неизвестный алгоритм сжатия: {compression}")
+        self.compression = CODECS.get(compression)
+        self.compression_level = compression_level
+        # Шифрование, теги и сжатие выполняются вне цикла событий: 'thread', 'process' или None
+        self.crypto_executor = create_executor(crypto_executor, crypto_workers)
+        # Пул долгоживущих соединений, общий для всех сегментов и сессий клиента
+        self.pool = ChannelPool(channels, size=pool_size)
+        # Счётчики и гистограммы каналов и сессий вместо журнала каждого сегмента; trace_rate — доля
+        # сегментов, события которых попадают в трассировку. log_segments включает журнал сегментов
+        self.metrics = Metrics('client', trace_rate)
+        self.log_segments = log_segments
+        self.channel_labels = {ch['name']: (('channel', ch['name']),) for ch in channels}
+        self.metrics_server = None
+        for channel in channels:
+            self._register_channel_gauges(channel['name'])
+
+    def _register_channel_gauges(self, name):
+        # Глубина очередей канала вычисляется только при снимке метрик
+        labels, window, state = self.channel_labels[name], self.windows[name], self.channel_states[name]
+        self.metrics.gauge('window_used', labels, lambda: self.window_size - window.free)
+        self.metrics.gauge('window_waiters', labels, lambda: sum(len(queue) for queue in window.waiters.values()))
+        self.metrics.gauge('in_flight_bytes', labels, lambda: self.estimator.in_flight[name])
+        self.metrics.gauge('pending_replies', labels,
+                           lambda: sum(len(connection.pending) for connection in self.pool.connections[name]))
+        self.metrics.gauge('srtt_seconds', labels, lambda: state['latency'])
+        self.metrics.gauge('bandwidth_bytes_per_second', labels, lambda: state['bandwidth'])
+
+    async def serve_metrics(self, port, host='127.0.0.1'):
+        # Локальная HTTP-точка метрик клиента (см. protocol.metrics.serve_metrics)
+        self.metrics_server = await serve_metrics(self.metrics, host, port)
+        return self.metrics_server
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        await self.pool.close()  # Закрытие всех соединений пула
+        if self.crypto_executor is not None:
+            self.crypto_executor.shutdown(wait=False)
 
     async def send_data(self, data):
         logging.info(f"Начало отправки данных. Размер: {len(data)} байт")
-        total_start_time = time.time()
+        view = memoryview(data)
+
+        async def chunks():
+            # Сегменты берутся срезами memoryview, без копирования исходных данных
+            for offset in range(0, len(view), self.segment_size):
+                yield view[offset:offset + self.segment_size]
+
+        return await self.send_stream(chunks(), total_size=len(data))
 
-        # Шифруем данные перед отправкой
-        cipher = AES.new(self.encryption_key, AES.MODE_CBC)
-        iv = cipher.iv  # Инициализационный вектор
-        encrypted_data = cipher.encrypt(pad(data, AES.block_size))  # Шифрование с дополнением
+    async def send_file(self, path, chunk_size=64 * 1024):
+        logging.info(f"Начало отправки файла {path}")
 
-        # Разбиваем зашифрованные данные на сегменты
-        segments = [encrypted_data[i:i + self.segment_size] for i in range(0, len(encrypted_data), self.segment_size)]
-        total_segments = len(segments)
-        tasks = []
+        async def chunks():
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = await asyncio.to_thread(f.read, chunk_size)  # Чтение без блокировки цикла событий
+                    if not chunk:
+                        break
+                    yield chunk
 
-        # Отправляем ключ шифрования серверу
-        await self.send_encryption_key(iv)
+        return await self.send_stream(chunks(), total_size=os.path.getsize(path))
 
-        for segment_number, segment in enumerate(segments):
-            task = asyncio.create_task(
-                self.send_segment(segment_number, total_segments, segment)  # Отправка каждого сегмента
-            )
-            tasks.append(task)
+    async def send_stream(self, stream, total_size=None):
+        # Данные читаются, шифруются и сегментируются по мере поступления из асинхронного итератора.
+        # Если размер известен заранее, сервер получает общее число сегментов в кадрах v2.
+        # Возвращает идентификатор сессии; ConnectionError, если сегменты не доставлены
+        # или сервер не подтвердил завершение сессии
+        total_start_time = time.time()
+        expected_segments = math.ceil(total_size / self.segment_size) if total_size else 0
+        session = ClientSession(self.cipher)
+
+        # Отправляем ключ шифрования серверу и согласуем версию протокола
+        options = {OPTION_CIPHER: self.cipher, OPTION_SEGMENT_SIZE: self.segment_size}
+        if self.protocol_version >= 2 or self.cipher == CIPHER_GCM:
+            options[OPTION_VERSION] = max(self.protocol_version, 2)
+        if self.fec_block:
+            options[OPTION_FEC_BLOCK] = self.fec_block
+        if self.compression:
+            options[OPTION_COMPRESSION] = self.compression
+        if 0 < expected_segments < 1 << 32:
+            # Сервер сразу резервирует объём сессии; при сжатии — объём несжатых данных
+            options[OPTION_TOTAL_SEGMENTS] = expected_segments
+        await self.open_session(session, options)
+        self.metrics.count('sessions_opened')
+        if self.cipher == CIPHER_GCM and session.version < 2:
+            raise ConnectionError('Сервер не поддерживает протокол v2, необходимый для AES-GCM')
+        # Число сегментов в кадрах v2; после сжатия оно заранее неизвестно
+        frame_total = expected_segments
+        if self.compression and session.version >= COMPRESSION_VERSION:
+            stream = self._compress_stream(stream)
+            frame_total = 0
+        # Сегменты v2 передаются пачками в одном кадре, v1 — по одному
+        batch_size = self.batch_size if session.version >= 2 else 1
+        checksum = CHECKSUM_TAG if session.version >= 2 else CHECKSUM_SHA256
+        # В пул процессов буферы слотов не передать: шифротекст возвращается новыми объектами
+        in_place = not isinstance(self.crypto_executor, ProcessPoolExecutor)
+
+        # Зашифрованные сегменты лежат в слотах одного буфера, переиспользуемых после подтверждения:
+        # пачки в очереди, у отправителей и одна заполняемая. Для коротких передач известного размера
+        # буфер и число отправителей не больше нужного (слотов не меньше пачки, чтобы её можно было заполнить)
+        queue_size = self.queue_size
+        slot_count = (2 * queue_size + 1) * batch_size
+        if expected_segments:
+            queue_size = min(queue_size, math.ceil(expected_segments / batch_size))
+            slot_count = min(slot_count, max(expected_segments, batch_size))
+        slab = memoryview(bytearray(slot_count * self.segment_size))
+        slots = asyncio.Queue()
+        for offset in range(0, len(slab), self.segment_size):
+            slots.put_nowait(slab[offset:offset + self.segment_size])
+        # Постоянное число отправителей вместо задачи на каждый сегмент
+        queue = asyncio.Queue(maxsize=queue_size)
+        self.metrics.gauge('queue_depth', session.labels, queue.qsize)  # Зашифрованные пачки, ждущие отправки
+        senders = [
+            asyncio.create_task(self._send_queued_batches(session, queue, slots, frame_total))
+            for _ in range(queue_size)
+        ]
+        total_segments = 0
+        total_bytes = 0
+        batch = []
 
-        await asyncio.gather(*tasks)  # Дожидаемся завершения отправки всех сегментов
-        await self.send_fin_signal(total_segments)  # Отправляем сигнал завершения передачи
+        async def submit():
+            # Пачка шифруется в исполнителе, пока заполняется следующая; отправитель
+            # дожидается результата. Ожидание, если очередь заполнена
+            first = total_segments - len(batch)
+            outputs = [slot[:len(segment)] for slot, segment in batch] if in_place else None
+            encrypted = asyncio.ensure_future(run_in_executor(
+                self.crypto_executor, encrypt_segments, session.encryption_key, session.nonce, session.cipher,
+                self.segment_size, first, [segment for _, segment in batch], outputs, checksum))
+            await queue.put((first, [slot for slot, _ in batch], encrypted))
+            self.metrics.trace_segments('queued', session.session_id, range(first, total_segments))
+
+        try:
+            async for segment in self._split_segments(stream):
+                if session.failed:
+                    break  # Передача уже не удалась: остаток потока не читается
+                batch.append((await slots.get(), segment))
+                total_segments += 1
+                total_bytes += len(segment)
+                if len(batch) == batch_size:
+                    await submit()
+                    batch = []
+            if batch and not session.failed:
+                await submit()
+            for _ in senders:
+                await queue.put(None)  # Сигнал отправителям о конце потока
+            await asyncio.gather(*senders)  # Дожидаемся завершения отправки всех сегментов
+            if session.failed:
+                raise ConnectionError(
+                    f"[Сессия {session.session_id}] Не удалось отправить сегменты после "
+                    f"{self.retransmission_limit} попыток, первый из них — {min(session.failed) + 1}")
+            if not await self.send_fin_signal(session, total_segments):  # Отправляем сигнал завершения передачи
+                raise ConnectionError(f"[Сессия {session.session_id}] Сервер не подтвердил завершение передачи")
+        except BaseException:
+            for sender in senders:
+                sender.cancel()
+            # Отправители снимают свои кадры с очереди каналов до того, как ошибка выйдет из send_stream
+            await asyncio.gather(*senders, return_exceptions=True)
+            self.metrics.count('sessions_failed')
+            self.metrics.forget(session.labels)
+            raise
 
         total_end_time = time.time()
-        logging.info(f"Отправка завершена. Общее время: {total_end_time - total_start_time:.2f} сек")
+        self.metrics.count('sessions_completed')
+        self.metrics.observe('transfer_seconds', (), total_end_time - total_start_time)
+        logging.info(
+            f"[Сессия {session.session_id}] Отправка завершена. Передано {total_bytes} байт, {total_segments} сегментов. "
+            f"Общее время: {total_end_time - total_start_time:.2f} сек")
+        self.metrics.forget(session.labels)  # Ряды сессии нужны, только пока она идёт
+        return session.session_id
+
+    async def _split_segments(self, stream, size=None):
+        # Нарезка потока произвольных фрагментов на сегменты ровно по size (segment_size) байт.
+        # Целые сегменты отдаются срезами memoryview фрагмента; копируются только сегменты
+        # на стыке двух фрагментов
+        size = size or self.segment_size
+        buffer = bytearray()
+        async for chunk in stream:
+            view = memoryview(chunk)
+            if buffer:
+                missing = size - len(buffer)
+                buffer += view[:missing]
+                view = view[missing:]
+                if len(buffer) < size:
+                    continue
+                yield bytes(buffer)
+                buffer.clear()
+            whole = len(view) - len(view) % size
+            for offset in range(0, whole, size):
+                yield view[offset:offset + size]
+            buffer += view[whole:]
+        if buffer:
+            yield bytes(buffer)
 
-    async def send_encryption_key(self, iv):
-        # Отправляем ключ шифрования и вектор инициализации по каждому каналу
-        for channel in self.channels:
+    async def _compress_stream(self, stream):
+        # Поток сжимается порциями по COMPRESSION_CHUNK_SIZE байт в исполнителе шифрования:
+        # несколько порций сжимаются одновременно, пока читаются следующие
+        pending = collections.deque()
+
+        async def compressed():
+            chunk, framed = pending.popleft()
+            framed = (await framed)[0]
+            self.metrics.count('compression_input_bytes', (), len(chunk))
+            self.metrics.count('compression_output_bytes', (), len(framed))
+            if framed[0] == CHUNK_STORED:
+                self.metrics.count('compression_stored_chunks')
+            return framed
+
+        try:
+            async for chunk in self._split_segments(stream, COMPRESSION_CHUNK_SIZE):
+                pending.append((chunk, asyncio.ensure_future(run_in_executor(
+                    self.crypto_executor, compress_chunks, self.compression, self.compression_level, [chunk]))))
+                if len(pending) >= COMPRESSION_AHEAD:
+                    yield await compressed()
+            while pending:
+                yield await compressed()
+        finally:
+            for _, framed in pending:
+                framed.cancel()
+
+    async def _send_queued_batches(self, session, queue, slots, total_segments):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            first, batch_slots, encrypted = item
             try:
-                reader, writer = await asyncio.open_connection(channel['host'], channel['port'])
-                header = struct.pack('!I 4s', self.session_id, b'KEY')  # Заголовок сообщения
-                data_length = struct.pack('!I', len(self.encryption_key) + len(iv))  # Длина данных
-                writer.write(header + data_length + self.encryption_key + iv)  # Отправка ключа
-                await writer.drain()  # Ожидание завершения отправки
-                ack = await reader.read(4)  # Ожидание подтверждения
-                if ack == b'ACK':
-                    logging.info(f"[Канал {channel['name']}] Ключ шифрования отправлен успешно")
+                segments, tags = await encrypted
+                if session.failed:
+                    continue  # Передача уже не удалась: пачки из очереди только освобождают слоты
+                if session.version >= 2:
+                    failed = await self.send_batch(session, first, segments, tags, total_segments)
                 else:
-                    logging.error(f"[Канал {channel['name']}] Ошибка при отправке ключа шифрования")
-            except Exception as e:
-                logging.error(f"[Канал {channel['name']}] Ошибка при отправке ключа: {e}")
+                    failed = await self.send_segment(session, first, total_segments, segments[0], tags[0])
+                session.failed.extend(failed)
             finally:
-                writer.close()  # Закрытие соединения
-                await writer.wait_closed()
+                for slot in batch_slots:
+                    # Слот свободен: кадр подтверждён сервером, а при ошибке соединение уже разорвано
+                    # и его неотправленные данные отброшены (PooledConnection.abort)
+                    slots.put_nowait(slot)
+
+    async def open_session(self, session, options=None):
+        # Каждая сессия получает случайный идентификатор. Таблица сессий сервера общая для всех каналов,
+        # поэтому KEY отправляется по одному каналу — с наименьшей оценённой задержкой, а следующему каналу
+        # только при ошибке соединения: открытие сессии не ждёт самый медленный канал. При BUSY (сервер
+        # перегружен) попытки повторяются с растущей паузой, при NACK (идентификатор занят) — с новым
+        # идентификатором. Возвращает согласованную версию протокола; ConnectionError, если сессия не открыта
+        def new_session_id():
+            return int.from_bytes(get_random_bytes(4), 'big')  # Поле идентификатора — 4 байта
 
-    async def send_segment(self, segment_number, total_segments, segment):
+        delay = self.busy_backoff
+        session.session_id = new_session_id()
+        for _ in range(self.admission_attempts):
+            for channel in self.channels_by_latency():
+                reply, version = await self.send_encryption_key(session, options, channel)
+                if reply is not None:
+                    break  # Сервер ответил: другой канал ответит так же
+            if reply in (ACK, KEY_ACCEPTED):
+                break
+            if reply is None:
+                raise ConnectionError('Ни один канал не доступен')
+            if reply == SESSION_TOO_LARGE:
+                # Сервер не примет сессию такого объёма: повторять KEY бесполезно
+                raise ConnectionError('Объём данных больше допустимого объёма сессии сервера')
+            if reply == NACK:
+                session.session_id = new_session_id()  # Идентификатор занят другой сессией
+                continue
+            if reply != SESSION_BUSY:
+                raise ConnectionError(f'Сервер отклонил ключ сессии: {reply}')
+            self.metrics.count('sessions_busy')
+            logging.warning(f"Сервер не принимает новые сессии, повтор через {delay:.1f} сек")
+            await asyncio.sleep(delay)
+            delay *= 2
+        else:
+            raise ConnectionError('Сервер не принял сессию')
+        session.version = version
+        session.labels = (('session', session.session_id),)
+        self.session_id = session.session_id
+        return session.version
+
+    def channels_by_latency(self):
+        # Каналы в порядке оценённой задержки; неизмеренные — первыми, в порядке конфигурации
+        return sorted(self.channels, key=lambda ch: self.channel_states[ch['name']]['latency'])
+
+    async def send_encryption_key(self, session, options, channel):
+        # Отправляем ключ шифрования, вектор инициализации и параметры сессии по каналу.
+        # Возвращает (ответ сервера, версия протокола); (None, None) — ошибка соединения
+        payload = session.encryption_key + session.nonce + bytes(8) + encode_key_options(options or {})
+        header = FRAME_HEADER.pack(session.session_id, CODE_KEY)  # Заголовок сообщения
+        data_length = DATA_LENGTH.pack(len(payload))  # Длина данных
+        try:
+            reply, version = await self.pool.request(
+                channel, [header, data_length, payload], read_key_reply)  # Отправка ключа
+        except Exception as e:
+            self.metrics.count('errors', self.channel_labels[channel['name']])
+            logging.error(f"[Канал {channel['name']}] Ошибка при отправке ключа: {e}")
+            return None, None
+        if reply in (ACK, KEY_ACCEPTED):
+            logging.info(f"[Канал {channel['name']}] Ключ шифрования отправлен успешно (протокол v{version})")
+        else:
+            logging.warning(f"[Канал {channel['name']}] Сервер отклонил ключ шифрования: {reply}")
+        return reply, version
+
+    async def send_segment(self, session, segment_number, total_segments, segment, checksum):
+        # Возвращает список из номера сегмента, если он не доставлен, иначе пустой список
         retries = 0  # Счетчик повторных попыток
         success = False  # Флаг успешности отправки сегмента
+        header = WINDOWED_SEGMENT_HEADER.pack(
+            session.session_id, CODE_WINDOWED_SEGMENT, segment_number, checksum)  # Заголовок сегмента
+        data_length = DATA_LENGTH.pack(len(segment))  # Длина сегмента
         while retries < self.retransmission_limit and not success:
-            channel = self.select_best_channel()  # Выбор лучшего канала
+            if segment_number < session.cumulative_ack:
+                # Сервер уже подтвердил сегмент кумулятивно: повторная отправка не нужна
+                success = True
+                break
+            channel = self.scheduler.select(len(segment))  # Выбор канала планировщиком
+            labels = self.channel_labels[channel['name']]
+            self.estimator.assign(channel['name'], len(segment))
+            if retries:
+                self.metrics.count('segments_retransmitted')
+                self.metrics.count('segments_retransmitted', session.labels)
+            replied = False
             try:
-                start_time = time.time()
-                reader, writer = await asyncio.open_connection(channel['host'], channel['port'])
-                checksum = hashlib.sha256(segment).digest()  # Вычисление контрольной суммы
-                header = struct.pack('!I I 32s', self.session_id, segment_number, checksum)  # Заголовок сегмента
-                data_length = struct.pack('!I', len(segment))  # Длина сегмента
-                writer.write(header + data_length + segment)  # Отправка сегмента
-                await writer.drain()  # Ожидание завершения отправки
-                ack = await reader.read(4)  # Ожидание подтверждения
-                end_time = time.time()
-                latency = end_time - start_time  # Измерение задержки
-                bandwidth = len(segment) / latency  # Вычисление пропускной способности
-                self.update_channel_state(channel['name'], latency, bandwidth)  # Обновление состояний канала
-                if ack == b'ACK':
-                    logging.info(f"[Канал {channel['name']}] Сегмент {segment_number + 1}/{total_segments} отправлен успешно")
+                # Сегмент занимает место в окне канала, пока не придёт подтверждение
+                async with self.windows[channel['name']].slot(session.session_id):
+                    snapshot = self.estimator.on_send(channel['name'])
+                    self.count_sent(session, labels, 1, len(segment))
+                    self.metrics.trace_segments('sent', session.session_id, (segment_number,), channel['name'])
+                    status, _, cumulative = await self.pool.request(
+                        channel, [header, data_length, segment], read_windowed_reply)  # Отправка сегмента
+                replied = True
+                session.cumulative_ack = max(session.cumulative_ack, cumulative)
+                self.metrics.observe('rtt_seconds', labels, time.monotonic() - snapshot[1])
+                if status == WINDOWED_ACK_OK:
+                    self.metrics.trace_segments('acked', session.session_id, (segment_number,), channel['name'])
+                    if self.log_segments:
+                        progress = f"{segment_number + 1}/{total_segments}" if total_segments else f"{segment_number + 1}"
+                        logging.info(f"[Канал {channel['name']}] Сегмент {progress} отправлен успешно")
                     success = True
                 else:
+                    # Выборочный отказ: повторно передаётся только этот сегмент
+                    self.count_nacked(session, channel['name'], [segment_number])
                     logging.warning(f"[Канал {channel['name']}] NACK при отправке сегмента {segment_number + 1}")
                     retries += 1
             except Exception as e:
+                self.metrics.count('errors', labels)
+                self.metrics.trace_segments('lost', session.session_id, (segment_number,), channel['name'])
                 logging.error(f"[Канал {channel['name']}] Ошибка: {e}")
                 retries += 1
             finally:
-                writer.close()  # Закрытие соединения
-                await writer.wait_closed()
+                # Сегмент снимается с очереди канала в оценке при любом исходе, в том числе при отмене отправителя
+                if replied:
+                    self.estimator.on_ack(channel['name'], snapshot, len(segment))  # Обновление оценок канала
+                else:
+                    self.estimator.on_loss(channel['name'], len(segment))
 
         if not success:
+            self.metrics.count('segments_failed')
             logging.error(f"Не удалось отправить сегмент {segment_number + 1} после {self.retransmission_limit} попыток")
+            return [segment_number]
+        return []
+
+    async def send_batch(self, session, first, segments, tags, total_segments=0):
+        # Пачка подряд идущих сегментов v2 с готовыми тегами; повторно передаются только неподтверждённые.
+        # Возвращает номера сегментов, не доставленных после всех попыток
+        pending = list(range(len(segments)))
+        retries = 0
+        if self.fec_block and session.version >= 3:
+            # Вместе с пачкой по другому каналу уходит чётность её блоков: один потерянный
+            # или повреждённый сегмент блока сервер восстановит без повторной передачи
+            parities, parity_tags = await run_in_executor(
+                self.crypto_executor, encode_parity, session.encryption_key, first, self.fec_block, segments)
+            nbytes = sum(len(segment) for segment in segments)
+            channel = self.scheduler.select(nbytes)
+            failed, recovered = await asyncio.gather(
+                self.send_v2_frame(session, first, segments, tags, total_segments, channel=channel),
+                self.send_parity_frame(session, first, parities, parity_tags, total_segments,
+                                       self.scheduler.select_other(nbytes // self.fec_block, channel)))
+            pending = [i - first for i in failed if i not in recovered]
+            retries = 1 if pending else 0
+        while pending and retries < self.retransmission_limit:
+            # Сегменты, подтверждённые кумулятивно (в том числе по другим каналам), не повторяем
+            pending = [i for i in pending if first + i >= session.cumulative_ack]
+            if not pending:
+                break
+            if retries:
+                self.metrics.count('segments_retransmitted', (), len(pending))
+                self.metrics.count('segments_retransmitted', session.labels, len(pending))
+            # Каждая непрерывная серия недоставленных сегментов уходит одним кадром
+            runs = []
+            for i in pending:
+                if runs and runs[-1][-1] == i - 1:
+                    runs[-1].append(i)
+                else:
+                    runs.append([i])
+            results = await asyncio.gather(*(
+                self.send_v2_frame(
+                    session, first + run[0], [segments[i] for i in run], [tags[i] for i in run], total_segments)
+                for run in runs
+            ))
+            pending = [i - first for failed in results for i in failed]
+            if pending:
+                retries += 1
+
+        if pending:
+            self.metrics.count('segments_failed', (), len(pending))
+            logging.error(
+                f"Не удалось отправить сегменты {[first + i + 1 for i in pending]} после {self.retransmission_limit} попыток")
+        return [first + i for i in pending]
+
+    async def send_v2_frame(self, session, first, segments, tags, total_segments=0, channel=None):
+        # Возвращает номера сегментов кадра, которые сервер не подтвердил
+        channel = channel or self.scheduler.select(sum(len(segment) for segment in segments))  # Выбор канала
+        reply = await self._request_v2_frame(session, channel, 0, first, segments, tags, total_segments)
+        if reply is None:
+            return list(range(first, first + len(segments)))
+        code, count, bitmap = reply
+        failed = [first + i for i in range(len(segments))
+                  if code not in (V2_ACK_CODE, V2_BUSY_CODE) or i >= count or not bitmap[i >> 3] & (0x80 >> (i & 7))]
+        if failed:
+            # Выборочный отказ: повторно передаются только отмеченные сегменты
+            self.count_nacked(session, channel['name'], failed)
+            self.metrics.trace_segments('acked', session.session_id, sorted(
+                set(range(first, first + len(segments))).difference(failed)), channel['name'])
+            logging.warning(f"[Канал {channel['name']}] NACK для сегментов {[i + 1 for i in failed]}")
+        else:
+            self.metrics.trace_segments('acked', session.session_id, range(first, first + len(segments)), channel['name'])
+            if self.log_segments:
+                logging.info(f"[Канал {channel['name']}] Сегменты {first + 1}-{first + len(segments)} отправлены успешно")
+        return failed
+
+    async def send_parity_frame(self, session, first, parities, tags, total_segments, channel):
+        # Возвращает номера сегментов, которые сервер восстановил по этой чётности
+        reply = await self._request_v2_frame(session, channel, FLAG_PARITY, first, parities, tags, total_segments)
+        if reply is None:
+            return set()
+        code, count, bitmap = reply
+        recovered = {first + i for i in range(count) if code == V2_ACK_CODE and bitmap[i >> 3] & (0x80 >> (i & 7))}
+        if recovered:
+            self.metrics.count('segments_recovered', self.channel_labels[channel['name']], len(recovered))
+            self.metrics.trace_segments('recovered', session.session_id, sorted(recovered), channel['name'])
+            logging.info(f"[Канал {channel['name']}] Сервер восстановил по чётности сегменты {sorted(i + 1 for i in recovered)}")
+        return recovered
 
-    async def send_fin_signal(self, total_segments):
-        # Отправляем сигнал завершения передачи
-        for channel in self.channels:
+    async def _request_v2_frame(self, session, channel, flags, first, entries, tags, total_segments):
+        # Отправляет кадр v2 по каналу; возвращает (код, число сегментов, битовая карта) или None при ошибке
+        nbytes = sum(len(entry) for entry in entries)
+        tag_size = len(tags[0])  # Тег BLAKE2b или AES-GCM
+        buffers = [FRAME_HEADER.pack(session.session_id, CODE_V2_DATA),
+                   V2_FRAME_TAIL.pack(flags, tag_size, len(entries), first, total_segments),
+                   DATA_LENGTH.pack(nbytes + len(entries) * (V2_ENTRY.size + tag_size))]
+        for entry, tag in zip(entries, tags):
+            buffers += (V2_ENTRY.pack(len(entry)), tag, entry)
+
+        labels = self.channel_labels[channel['name']]
+        parity = flags & FLAG_PARITY
+        self.estimator.assign(channel['name'], nbytes)
+        replied = False
+        try:
+            # Кадр занимает место в окне канала, пока не придёт подтверждение
+            async with self.windows[channel['name']].slot(session.session_id):
+                delay = self.busy_backoff
+                for attempt in range(self.admission_attempts):
+                    snapshot = self.estimator.on_send(channel['name'])
+                    if parity:
+                        self.metrics.count('parity_frames_sent', labels)
+                        self.metrics.count('parity_bytes_sent', labels, nbytes)
+                    else:
+                        self.count_sent(session, labels, len(entries), nbytes)
+                        self.metrics.trace_segments(
+                            'sent', session.session_id, range(first, first + len(entries)), channel['name'])
+                    code, cumulative, _, count, bitmap = await self.pool.request(channel, buffers, read_v2_reply)
+                    if code != V2_BUSY_CODE or attempt == self.admission_attempts - 1:
+                        break
+                    # Сервер исчерпал общий объём данных: кадр повторяется с паузой, не освобождая
+                    # окно канала, поэтому отправка замедляется, пока сервер не завершит другие сессии
+                    self.metrics.count('busy_replies', labels)
+                    logging.warning(f"[Канал {channel['name']}] Сервер перегружен, повтор через {delay:.1f} сек")
+                    await asyncio.sleep(delay)
+                    delay *= 2
+            replied = True
+        except Exception as e:
+            self.metrics.count('errors', labels)
+            if not parity:
+                self.metrics.trace_segments('lost', session.session_id, range(first, first + len(entries)), channel['name'])
+            logging.error(f"[Канал {channel['name']}] Ошибка: {e}")
+            return None
+        finally:
+            # Кадр снимается с очереди канала в оценке при любом исходе, в том числе при отмене отправителя
+            if replied:
+                self.estimator.on_ack(channel['name'], snapshot, nbytes)  # Обновление оценок канала
+            else:
+                self.estimator.on_loss(channel['name'], nbytes)
+        session.cumulative_ack = max(session.cumulative_ack, cumulative)
+        self.metrics.observe('rtt_seconds', labels, time.monotonic() - snapshot[1])
+        return code, count, bitmap
+
+    def count_sent(self, session, labels, segments, nbytes):
+        # Кадр с сегментами данных отправлен по каналу (считается каждая попытка)
+        self.metrics.count('frames_sent', labels)
+        self.metrics.count('segments_sent', labels, segments)
+        self.metrics.count('bytes_sent', labels, nbytes)
+        self.metrics.count('segments_sent', session.labels, segments)
+        self.metrics.count('bytes_sent', session.labels, nbytes)
+
+    def count_nacked(self, session, channel_name, failed):
+        self.metrics.count('segments_nacked', self.channel_labels[channel_name], len(failed))
+        self.metrics.count('segments_nacked', session.labels, len(failed))
+        self.metrics.trace_segments('nacked', session.session_id, failed, channel_name)
+
+    async def send_fin_signal(self, session, total_segments):
+        # Отправляем сигнал завершения передачи вместе с общим числом сегментов по каналу с наименьшей
+        # задержкой, а следующему каналу — только при ошибке соединения.
+        # Возвращает True, если сервер подтвердил завершение сессии
+        header = FRAME_HEADER.pack(session.session_id, CODE_FIN)  # Заголовок завершения
+        if session.version >= 2:
+            frame = [header, DATA_LENGTH.pack(V2_TOTAL.size), V2_TOTAL.pack(total_segments)]
+        else:
+            frame = [header, DATA_LENGTH.pack(DATA_LENGTH.size), DATA_LENGTH.pack(total_segments)]
+
+        for channel in self.channels_by_latency():
             try:
-                reader, writer = await asyncio.open_connection(channel['host'], channel['port'])
-                header = struct.pack('!I 4s', self.session_id, b'FIN')  # Заголовок завершения
-                data_length = struct.pack('!I', 0)  # Длина данных
-                writer.write(header + data_length)  # Отправка сигнала завершения
-                await writer.drain()  # Ожидание завершения отправки
-                ack = await reader.read(4)  # Ожидание подтверждения
-                if ack == b'ACK':
-                    logging.info(f"[Канал {channel['name']}] Сигнал завершения передачи отправлен успешно")
+                if session.version >= 2:
+                    code, cumulative, _, _, _ = await self.pool.request(channel, frame, read_v2_reply)
+                    ok = code == V2_ACK_CODE
                 else:
-                    logging.error(f"[Канал {channel['name']}] Ошибка при отправке сигнала завершения передачи")
+                    status, _, cumulative = await self.pool.request(channel, frame, read_windowed_reply)
+                    ok = status == WINDOWED_ACK_OK
             except Exception as e:
+                self.metrics.count('errors', self.channel_labels[channel['name']])
                 logging.error(f"[Канал {channel['name']}] Ошибка: {e}")
-            finally:
-                writer.close()  # Закрытие соединения
-                await writer.wait_closed()
+                continue
+            if ok:
+                logging.info(f"[Канал {channel['name']}] Сигнал завершения передачи отправлен успешно")
+            else:
+                logging.error(
+                    f"[Канал {channel['name']}] Сервер получил только {cumulative}/{total_segments} сегментов подряд")
+            return ok
+        return False
 
     def update_channel_state(self, channel_name, latency, bandwidth):
-        # Обновляем информацию о задержке и пропускной способности канала
-        self.channel_states[channel_name]['latency'] = latency
-        self.channel_states[channel_name]['bandwidth'] = bandwidth
-
-    def select_best_channel(self):
-        # Выбор канала на основе задержки и пропускной способности
-        def channel_score(ch):
-            latency = self.channel_states[ch['name']]['latency'] or float('inf')
-            bandwidth = self.channel_states[ch['name']]['bandwidth'] or 0.0
-            return latency / (bandwidth + 1e-6)  # Рассчитываем оценку канала
-
-        sorted_channels = sorted(self.channels, key=channel_score)  # Сортировка каналов по оценке
-        return sorted_channels[0]  # Возвращаем канал с наилучшей оценкой
+        # Обновляем сглаженные оценки задержки и пропускной способности канала
+        self.estimator.update(channel_name, latency, bandwidth)
 
 async def main():
     channels = [
         {'name': 'Channel1', 'host': '127.0.0.1', 'port': 8888},
         {'name': 'Channel2', 'host': '127.0.0.1', 'port': 8889},
     ]
-    client = AggregatedClient(('127.0.0.1', 9000), channels)  # Создание клиента
     data = ('Данные для передачи ' * 1000).encode('utf-8')  # Данные для отправки
-    await client.send_data(data)  # Отправка данных
-
-if __name__ == '__main__':
-    asyncio.run(main())  # Запуск основной функции
\ No newline at end of file
+    # Повторяющийся текст хорошо сжимается: по каналам передаётся в разы меньше данных
+    async with AggregatedClient(('127.0.0.1', 9000), channels, compression='zlib') as client:  # Создание клиента
+        await client.send_data(data)  # Отправка данных
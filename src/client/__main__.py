@@ -0,0 +1,6 @@
+# python -m client
+import asyncio
+
+from . import main
+
+asyncio.run(main())  # Запуск основной функции
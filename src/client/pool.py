@@ -0,0 +1,155 @@
+# pool.py
+import asyncio
+import collections
+import logging
+from contextlib import asynccontextmanager
+
+from protocol import read_reply
+
+
+class PooledConnection:
+    def __init__(self, channel):
+        self.channel = channel  # Канал, к которому относится соединение
+        self.reader = None
+        self.writer = None
+        self.requests_served = 0  # Количество кадров, подтверждённых по соединению
+        self.generation = 0  # Номер подключения, растёт при каждом переподключении
+        # Кадры, ожидающие ответа: сервер отвечает на них строго по порядку
+        self.pending = collections.deque()
+        self.read_task = None  # Задача, разбирающая ответы сервера
+        self.has_pending = asyncio.Event()  # Сигнал задаче чтения о новых кадрах
+        self.connect_lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.channel['host'], self.channel['port'])
+        self.requests_served = 0
+        self.generation += 1
+        self.read_task = asyncio.create_task(self._read_replies(self.reader))
+        logging.debug(f"[Канал {self.channel['name']}] Установлено соединение пула")
+
+    def is_healthy(self):
+        # Соединение пригодно, если оно открыто и сервер не закрыл его со своей стороны
+        if self.writer is None or self.writer.is_closing():
+            return False
+        return not self.reader.at_eof()
+
+    async def request(self, buffers, read_response=read_reply, timeout=None):
+        # Отправка кадра без ожидания предыдущих ответов (конвейерная передача).
+        # Кадр передаётся частями (заголовок, срез данных) без склейки в один буфер.
+        # Ответ разбирается функцией read_response, когда до него дойдёт очередь.
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((future, read_response))
+        self.has_pending.set()
+        self.writer.writelines(buffers)
+        await self.writer.drain()
+        # Не wait_for: если ответ пришёл одновременно с отменой отправителя, wait_for возвращает ответ
+        # и теряет отмену, и отправитель продолжает работу после завершения передачи
+        try:
+            done, _ = await asyncio.wait((future,), timeout=timeout)
+        finally:
+            if not future.done():
+                future.cancel()  # Тайм-аут или отмена: ответ, когда придёт, будет пропущен
+        if not done:
+            raise asyncio.TimeoutError()
+        return future.result()
+
+    async def _read_replies(self, reader):
+        try:
+            while True:
+                if not self.pending:
+                    # Ответов не ждём; закрытие соединения сервером заметит is_healthy
+                    self.has_pending.clear()
+                    await self.has_pending.wait()
+                    continue
+                future, read_response = self.pending[0]
+                response = await read_response(reader)
+                self.pending.popleft()
+                self.requests_served += 1
+                if not future.done():
+                    future.set_result(response)
+        except asyncio.IncompleteReadError:
+            self._fail_pending(ConnectionResetError('сервер закрыл соединение'))
+        except Exception as e:
+            self._fail_pending(e)
+
+    def _fail_pending(self, error):
+        # Все неподтверждённые кадры соединения считаются потерянными
+        while self.pending:
+            future, _ = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    def abort(self):
+        if self.writer is not None:
+            # Неотправленные данные отбрасываются сразу, а не дописываются при закрытии: транспорт
+            # может хранить переданные в writelines срезы без копирования (Python 3.12+), а буферы
+            # кадров после ошибки возвращаются отправителю для новых данных
+            self.writer.transport.abort()
+        if self.read_task is not None:
+            self.read_task.cancel()
+        self._fail_pending(ConnectionResetError('соединение закрыто'))
+        self.reader = self.writer = self.read_task = None
+
+    async def close(self):
+        if self.writer is None:
+            return
+        writer = self.writer
+        self.abort()
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass  # Соединение уже разорвано
+
+
+class ChannelPool:
+    def __init__(self, channels, size=2, connect_timeout=5.0, reply_timeout=30.0):
+        self.channels = {ch['name']: ch for ch in channels}  # Каналы по имени
+        self.size = size  # Количество долгоживущих соединений на канал
+        self.connect_timeout = connect_timeout  # Таймаут установления соединения
+        self.reply_timeout = reply_timeout  # Таймаут ожидания ответа сервера
+        self.connections = {
+            name: [PooledConnection(ch) for _ in range(size)] for name, ch in self.channels.items()
+        }
+        self.closed = False
+
+    async def acquire(self, channel):
+        if self.closed:
+            raise RuntimeError('пул соединений закрыт')
+        # Соединения разделяются между запросами: выбираем наименее загруженное
+        connection = min(self.connections[channel['name']], key=lambda c: len(c.pending))
+        if not connection.is_healthy():
+            async with connection.connect_lock:
+                if not connection.is_healthy():
+                    # Проверка состояния: переподключаемся вместо разорванного соединения
+                    await connection.close()
+                    await asyncio.wait_for(connection.connect(), self.connect_timeout)
+        return connection
+
+    def release(self, connection, generation, broken=False):
+        # Соединение могли уже переподключить другие запросы: новое подключение не трогаем
+        if (broken or self.closed) and connection.generation == generation:
+            # Разорванное соединение закрываем сразу, до того как ошибка дойдёт до отправителя кадра,
+            # переподключение произойдёт при следующем захвате
+            connection.abort()
+
+    @asynccontextmanager
+    async def connection(self, channel):
+        connection = await self.acquire(channel)
+        generation = connection.generation
+        try:
+            yield connection
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            self.release(connection, generation, broken=True)
+            raise
+        else:
+            self.release(connection, generation)
+
+    async def request(self, channel, buffers, read_response=read_reply):
+        async with self.connection(channel) as connection:
+            return await connection.request(buffers, read_response, self.reply_timeout)
+
+    async def close(self):
+        self.closed = True
+        for connections in self.connections.values():
+            for connection in connections:
+                await connection.close()
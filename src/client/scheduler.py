@@ -0,0 +1,188 @@
+# scheduler.py
+# Распределение сегментов по каналам пропорционально их оценённой пропускной способности
+import time
+
+
+class ChannelEstimator:
+    def __init__(self, channels, alpha=0.125, base_window=10.0):
+        self.alpha = alpha  # Коэффициент экспоненциального сглаживания (EWMA)
+        self.base_window = base_window  # За сколько секунд берётся наименьшая задержка
+        # Оценки каналов: сглаженная задержка (сек), скорость доставки (байт/сек) и наименьшая задержка
+        # за base_window секунд — время обращения без очереди в канале
+        self.states = {
+            ch['name']: {'latency': 0.0, 'bandwidth': 0.0, 'samples': 0, 'base_latency': 0.0, 'base_at': 0.0}
+            for ch in channels
+        }
+        # Счётчики доставленных байт для измерения скорости доставки при конвейерной передаче
+        self.delivered = {ch['name']: 0 for ch in channels}
+        self.in_flight = {ch['name']: 0 for ch in channels}  # Байты, ожидающие подтверждения
+        self.cached_capacities = None  # Оценки capacities() до следующего замера
+
+    def assign(self, channel_name, nbytes):
+        # Сегмент назначен каналу: учитывается в очереди канала до подтверждения или потери
+        self.in_flight[channel_name] += nbytes
+
+    def on_send(self, channel_name):
+        # Снимок состояния канала на момент отправки; возвращается при подтверждении
+        return self.delivered[channel_name], time.monotonic(), self.in_flight[channel_name]
+
+    def on_ack(self, channel_name, snapshot, nbytes):
+        delivered_at_send, sent_at, in_flight_at_send = snapshot
+        now = time.monotonic()
+        self.in_flight[channel_name] -= nbytes
+        self.delivered[channel_name] += nbytes
+        latency = now - sent_at
+        # Скорость доставки: сколько байт канал подтвердил за время, пока сегмент был в пути.
+        # В отличие от len(segment) / latency, оценка не занижается при нескольких
+        # сегментах в окне.
+        bandwidth = (self.delivered[channel_name] - delivered_at_send) / max(latency, 1e-6)
+        state = self.states[channel_name]
+        if bandwidth < state['bandwidth'] and in_flight_at_send < state['bandwidth'] * state['base_latency']:
+            # В канале было меньше данных, чем он успевает передать за время обращения: замер показывает
+            # нагрузку, а не скорость канала, и может только повысить оценку
+            bandwidth = None
+        self.update(channel_name, latency, bandwidth)
+
+    def on_loss(self, channel_name, nbytes):
+        self.in_flight[channel_name] -= nbytes
+
+    def update(self, channel_name, latency, bandwidth=None):
+        # bandwidth=None — замер задержки без замера скорости
+        state = self.states[channel_name]
+        now = time.monotonic()
+        if not state['samples'] or latency <= state['base_latency'] or now - state['base_at'] > self.base_window:
+            state['base_latency'], state['base_at'] = latency, now
+        if not state['samples']:
+            state['latency'], state['bandwidth'] = latency, bandwidth or 0.0
+        else:
+            state['latency'] += self.alpha * (latency - state['latency'])
+            if bandwidth is not None:
+                state['bandwidth'] += self.alpha * (bandwidth - state['bandwidth'])
+        state['samples'] += 1
+        self.cached_capacities = None
+
+    def capacities(self):
+        # Каналы без измерений получают среднюю оценку остальных, чтобы их опробовать.
+        # Пересчитываются только после нового замера: планировщик запрашивает их на каждый сегмент
+        if self.cached_capacities is not None:
+            return self.cached_capacities
+        measured = [s['bandwidth'] for s in self.states.values() if s['samples']]
+        default = sum(measured) / len(measured) if measured else 1.0
+        self.cached_capacities = {
+            name: (s['bandwidth'] if s['samples'] else default) or default for name, s in self.states.items()}
+        return self.cached_capacities
+
+    def expected_completion(self, channel_name, nbytes, capacities):
+        # Ожидаемое время подтверждения сегмента, поставленного в канал сейчас. Очередь канала учтена
+        # в queued, поэтому задержка берётся без неё: сглаженная задержка учла бы очередь дважды
+        queued = self.in_flight[channel_name] + nbytes
+        return self.states[channel_name]['base_latency'] + queued / capacities[channel_name]
+
+
+class Scheduler:
+    def __init__(self, channels, estimator, min_share=0.05):
+        self.channels = channels
+        self.estimator = estimator
+        self.min_share = min_share  # Минимальная доля трафика, чтобы не терять оценку простаивающего канала
+
+    def weights(self):
+        capacities = self.estimator.capacities()
+        total = sum(capacities.values())
+        shares = [max(capacities[ch['name']] / total, self.min_share) for ch in self.channels]
+        norm = sum(shares)
+        return [share / norm for share in shares]
+
+    def select(self, nbytes):
+        raise NotImplementedError
+
+    def unless_backlogged(self, channel, nbytes):
+        # Доли каналов не учитывают их очередь: медленный канал с заполненным окном подтвердит сегмент
+        # намного позже, и на нём задерживается конец передачи. Такой сегмент уходит в канал, который
+        # подтвердит его раньше всех, если выбранный опоздает больше чем на своё время обращения
+        capacities = self.estimator.capacities()
+        completion = {ch['name']: self.estimator.expected_completion(ch['name'], nbytes, capacities)
+                      for ch in self.channels}
+        earliest = min(self.channels, key=lambda ch: completion[ch['name']])
+        late = completion[channel['name']] - completion[earliest['name']]
+        return earliest if late > self.estimator.states[channel['name']]['base_latency'] else channel
+
+    def select_other(self, nbytes, channel):
+        # Канал для избыточных данных (чётности): раньше всех завершит передачу среди остальных каналов
+        others = [ch for ch in self.channels if ch is not channel]
+        if not others:
+            return channel
+        capacities = self.estimator.capacities()
+        return min(others, key=lambda ch: self.estimator.expected_completion(ch['name'], nbytes, capacities))
+
+
+class WeightedRoundRobinScheduler(Scheduler):
+    def __init__(self, channels, estimator, slots=64, **kwargs):
+        super().__init__(channels, estimator, **kwargs)
+        self.slots = slots  # Длина таблицы расписания
+        self.table = []
+        self.position = 0
+
+    def rebuild(self):
+        # Плавный взвешенный round-robin: каналы в таблице перемежаются, а не идут пачками
+        weights = self.weights()
+        current = [0.0] * len(self.channels)
+        self.table = []
+        for _ in range(self.slots):
+            for i, weight in enumerate(weights):
+                current[i] += weight
+            best = max(range(len(current)), key=current.__getitem__)
+            current[best] -= 1.0
+            self.table.append(self.channels[best])
+        self.position = 0
+
+    def select(self, nbytes):
+        # Таблица пересчитывается раз в slots выборов, выбор из неё — O(1). Проверка очереди выбранного
+        # канала сравнивает ожидаемое время подтверждения во всех каналах: O(число каналов) на сегмент
+        if self.position >= len(self.table):
+            self.rebuild()
+        channel = self.table[self.position]
+        self.position += 1
+        return self.unless_backlogged(channel, nbytes)
+
+
+class DeficitRoundRobinScheduler(Scheduler):
+    def __init__(self, channels, estimator, quantum=16 * 1024, **kwargs):
+        super().__init__(channels, estimator, **kwargs)
+        self.quantum = quantum  # Байт на раунд для всех каналов вместе
+        self.deficits = [0.0] * len(channels)
+        self.quanta = [quantum / len(channels)] * len(channels)
+        self.current = 0
+
+    def select(self, nbytes):
+        # Канал отправляет, пока его дефицит покрывает сегмент, затем ход переходит к следующему
+        while self.deficits[self.current] < nbytes:
+            self.current = (self.current + 1) % len(self.channels)
+            if self.current == 0:
+                # Кванты обновляются раз в раунд по текущим оценкам
+                self.quanta = [weight * self.quantum for weight in self.weights()]
+            self.deficits[self.current] += self.quanta[self.current]
+        self.deficits[self.current] -= nbytes
+        return self.unless_backlogged(self.channels[self.current], nbytes)
+
+
+class EarliestCompletionScheduler(Scheduler):
+    def select(self, nbytes):
+        # Сегмент идёт в канал, где он будет подтверждён раньше всего с учётом очереди
+        capacities = self.estimator.capacities()
+        return min(self.channels, key=lambda ch: self.estimator.expected_completion(ch['name'], nbytes, capacities))
+
+
+SCHEDULERS = {
+    'wrr': WeightedRoundRobinScheduler,
+    'drr': DeficitRoundRobinScheduler,
+    'ecf': EarliestCompletionScheduler,
+}
+
+
+def create_scheduler(policy, channels, estimator):
+    if isinstance(policy, Scheduler):
+        return policy
+    try:
+        return SCHEDULERS[policy](channels, estimator)
+    except KeyError:
+        raise ValueError(f"Неизвестная политика распределения: {policy}") from None
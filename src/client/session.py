@@ -0,0 +1,68 @@
+# session.py
+# Состояние одной передачи: клиент ведёт несколько сессий одновременно по общим соединениям каналов
+import asyncio
+import collections
+from contextlib import asynccontextmanager
+
+from Crypto.Random import get_random_bytes
+
+
+class ClientSession:
+    def __init__(self, cipher):
+        self.session_id = None  # Случайный идентификатор, выбирается при открытии сессии
+        self.labels = None  # Метки рядов сессии в метриках клиента, задаются при открытии
+        self.version = 1  # Версия протокола, согласованная с сервером
+        self.encryption_key = get_random_bytes(16)  # Симметричный ключ AES сессии
+        # AES-CTR (и AES-GCM): каждый сегмент шифруется независимо по своему номеру
+        self.nonce = get_random_bytes(8)
+        self.cipher = cipher
+        # Кумулятивное подтверждение сервера: все сегменты с меньшими номерами получены
+        self.cumulative_ack = 0
+        # Сегменты, не доставленные после всех повторных попыток: передача сессии не удалась
+        self.failed = []
+
+
+class FairWindow:
+    # Окно канала, общее для всех сессий клиента: освободившееся место получает следующая по кругу
+    # сессия из ожидающих, поэтому большая передача с множеством отправителей не вытесняет короткие
+    def __init__(self, size):
+        self.free = size  # Свободные места окна
+        self.waiters = collections.OrderedDict()  # session_id -> очередь ожидающих отправителей сессии
+
+    @asynccontextmanager
+    async def slot(self, session_id):
+        await self.acquire(session_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, session_id):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(session_id, collections.deque()).append(future)
+        self._wake()  # Место могло освободиться, пока ожидали только отменённые отправители
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # Место уже выделено отменённому отправителю
+            raise
+
+    def release(self):
+        self.free += 1
+        self._wake()
+
+    def _wake(self):
+        while self.free > 0 and self.waiters:
+            session_id, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(session_id)  # Следующее место — другой сессии
+            else:
+                del self.waiters[session_id]
+            if not future.done():  # Отменённые ожидания пропускаются
+                self.free -= 1
+                future.set_result(None)
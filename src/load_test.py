@@ -5,13 +5,20 @@ import random
 import csv
 from client import *
 
-async def run_client(data_size, server_address, channels, stats):
+async def run_client(data_size, server_address, channels, stats, client=None):
+    # client — общий экземпляр, ведущий передачи всех клиентов как отдельные сессии
+    # по одним соединениям; без него каждый клиент создаёт свой
     try:
-        client = AggregatedClient(server_address, channels)
         data = b'x' * data_size  # Создаем данные заданного размера
-        start_time = time.time()
-        await client.send_data(data)
-        end_time = time.time()
+        if client is not None:
+            start_time = time.time()
+            await client.send_data(data)
+            end_time = time.time()
+        else:
+            async with AggregatedClient(server_address, channels) as client:
+                start_time = time.time()
+                await client.send_data(data)
+                end_time = time.time()
         elapsed_time = end_time - start_time
         stats.append({
             'data_size': data_size,
@@ -35,13 +42,16 @@ async def main():
     tasks = []
     num_clients = 50  # Количество параллельных клиентов
     data_size = 2048  # Размер данных, отправляемых каждым клиентом (в байтах)
+    shared_client = True  # Все клиенты — сессии одного AggregatedClient
 
-    for _ in range(num_clients):
-        task = asyncio.create_task(run_client(data_size, server_address, channels, stats))
-        tasks.append(task)
-        await asyncio.sleep(random.uniform(0, 0.05))  # Случайная задержка между запусками клиентов
+    async with AggregatedClient(server_address, channels) as client:
+        for _ in range(num_clients):
+            task = asyncio.create_task(
+                run_client(data_size, server_address, channels, stats, client if shared_client else None))
+            tasks.append(task)
+            await asyncio.sleep(random.uniform(0, 0.05))  # Случайная задержка между запусками клиентов
 
-    await asyncio.gather(*tasks)
+        await asyncio.gather(*tasks)
 
     # Сохраняем статистику в CSV-файл
     with open('stats.csv', 'w', newline='') as csvfile:
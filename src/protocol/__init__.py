@@ -0,0 +1,116 @@
+# protocol.py
+# Общие для клиента и сервера описания кадров протокола
+import hashlib
+import struct
+
+# Заголовок любого кадра: идентификатор сессии и код сообщения
+FRAME_HEADER = struct.Struct('!I 4s')
+# Длина полезной нагрузки кадра
+DATA_LENGTH = struct.Struct('!I')
+# Сегмент данных оконного режима: номер сегмента и SHA-256 после кода SEGW
+WINDOWED_SEGMENT_HEADER = struct.Struct('!I 4s I 32s')
+WINDOWED_SEGMENT_TAIL = struct.Struct('!I 32s')  # Часть заголовка после общего FRAME_HEADER
+# Ответ оконного режима: статус, номер сегмента и кумулятивное подтверждение
+# (количество сегментов сессии, полученных подряд начиная с нулевого)
+WINDOWED_ACK = struct.Struct('!4s I I')
+
+# Кадр данных v2: после FRAME_HEADER с кодом DAT2 идут флаги, размер тега, число сегментов
+# в кадре, номер первого из них и общее число сегментов сессии (0 — ещё неизвестно).
+# Затем длина полезной нагрузки и сами сегменты, каждый как V2_ENTRY + тег + данные.
+# Сегменты одного кадра идут подряд: first, first + 1, ...
+V2_FRAME_TAIL = struct.Struct('!B B H Q Q')
+V2_ENTRY = struct.Struct('!I')  # Длина сегмента внутри кадра v2
+# Ответ v2 на кадр: кумулятивное подтверждение, первый сегмент и число сегментов кадра,
+# затем битовая карта (бит i установлен — сегмент first + i сохранён)
+V2_ACK = struct.Struct('!4s Q Q H')
+V2_TOTAL = struct.Struct('!Q')  # Полезная нагрузка FIN v2: общее число сегментов
+# Кадр чётности (v3, флаг FLAG_PARITY): по одной записи на блок из fec_block сегментов, начиная
+# с first. Данные записи — число сегментов блока, XOR их длин и XOR самих зашифрованных сегментов.
+# Ответ — V2_ACK с битовой картой сегментов, восстановленных сервером
+FEC_PARITY = struct.Struct('!H I')
+
+# Необязательные параметры сессии, передаваемые в KEY после ключа и IV: тип и значение
+KEY_OPTION = struct.Struct('!B I')
+
+CODE_KEY = b'KEY\x00'  # Передача ключа шифрования
+CODE_FIN = b'FIN\x00'  # Завершение передачи
+CODE_WINDOWED_SEGMENT = b'SEGW'  # Сегмент данных оконного режима
+CODE_V2_DATA = b'DAT2'  # Кадр v2 с одним или несколькими сегментами
+
+ACK = b'ACK'  # Подтверждение v1
+NACK = b'NACK'  # Отказ v1
+WINDOWED_ACK_OK = b'ACK\x00'  # Подтверждение оконного режима
+WINDOWED_ACK_FAIL = b'NACK'  # Отказ оконного режима
+V2_ACK_CODE = b'SAK2'  # Выборочное подтверждение v2
+V2_NACK_CODE = b'NAK2'  # Отказ v2 (FIN до получения всех сегментов)
+KEY_ACCEPTED = b'KEY'  # Ответ на KEY с согласованной версией: KEY + байт версии
+SESSION_BUSY = b'BUSY'  # Ответ на KEY: сервер не принимает новые сессии, повторить позже
+SESSION_TOO_LARGE = b'SIZE'  # Ответ на KEY: объём сессии больше допустимого, повторять бесполезно
+V2_BUSY_CODE = b'BSY2'  # Ответ на кадр v2: исчерпан общий объём данных сервера, повторить позже
+
+OPTION_CIPHER = 1  # Режим шифрования сессии
+OPTION_SEGMENT_SIZE = 2  # Размер сегмента в байтах
+OPTION_VERSION = 3  # Максимальная версия протокола, которую поддерживает клиент
+OPTION_FEC_BLOCK = 4  # Число сегментов в блоке, защищённом одним сегментом чётности (v3)
+OPTION_TOTAL_SEGMENTS = 5  # Общее число сегментов сессии, если известно заранее: сервер резервирует объём
+# Алгоритм сжатия данных сессии (protocol.compression), действует с версии 4: сегменты содержат
+# поток сжатых порций, который сервер распаковывает при завершении сессии
+OPTION_COMPRESSION = 6
+
+# Максимальная версия протокола этой реализации: v3 — v2 с кадрами чётности, v4 — v3 со сжатием
+PROTOCOL_VERSION = 4
+COMPRESSION_VERSION = 4  # Версия, с которой сервер понимает OPTION_COMPRESSION
+FLAG_PARITY = 0x02  # Кадр v3 содержит сегменты чётности вместо данных
+PARITY_TAG_OFFSET = 1 << 64  # Сдвиг номера в теге чётности, чтобы он не совпадал с тегом сегмента
+TAG_SIZE = 8  # Размер тега целостности сегмента v2
+
+CIPHER_CBC = 0  # AES-CBC над всем сообщением (клиенты v1)
+CIPHER_CTR = 1  # AES-CTR: каждый сегмент шифруется независимо по своему смещению
+CIPHER_GCM = 2  # AES-GCM (только v2): тег AEAD сегмента заменяет отдельный тег целостности
+
+
+def encode_key_options(options):
+    return b''.join(KEY_OPTION.pack(option, value) for option, value in options.items())
+
+
+def decode_key_options(data):
+    # Неизвестные параметры сохраняются, но игнорируются сервером
+    return dict(KEY_OPTION.iter_unpack(data[:len(data) - len(data) % KEY_OPTION.size]))
+
+
+def segment_tag(key, segment_number, data, size=TAG_SIZE):
+    # Компактный тег целостности: BLAKE2b с ключом сессии, привязанный к номеру сегмента
+    return hashlib.blake2b(data, digest_size=size, key=key, salt=segment_number.to_bytes(16, 'big')).digest()
+
+
+async def read_reply(reader):
+    # Ответы v1 разной длины, но различимы по первым трём байтам
+    reply = await reader.readexactly(3)
+    if reply == NACK[:3]:
+        reply += await reader.readexactly(1)
+    return reply
+
+
+async def read_windowed_reply(reader):
+    return WINDOWED_ACK.unpack(await reader.readexactly(WINDOWED_ACK.size))
+
+
+async def read_key_reply(reader):
+    # Сервер v1 отвечает ACK/NACK, сервер v2 — KEY и согласованной версией.
+    # Возвращает (ответ, версия протокола сессии); NACK — идентификатор сессии занят
+    # сессией с другим ключом, SESSION_BUSY — сервер перегружен, SESSION_TOO_LARGE — сессия
+    # заявленного объёма не будет принята
+    reply = await reader.readexactly(3)
+    if reply == ACK:
+        return ACK, 1
+    if reply == KEY_ACCEPTED:
+        return KEY_ACCEPTED, (await reader.readexactly(1))[0]
+    reply += await reader.readexactly(1)  # Оставшийся байт NACK, BUSY или SIZE
+    return reply, 1
+
+
+async def read_v2_reply(reader):
+    # Возвращает (код, кумулятивное подтверждение, первый сегмент, число сегментов, битовая карта)
+    code, cumulative, first, count = V2_ACK.unpack(await reader.readexactly(V2_ACK.size))
+    bitmap = await reader.readexactly((count + 7) // 8) if count else b''
+    return code, cumulative, first, count, bitmap
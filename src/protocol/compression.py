@@ -0,0 +1,100 @@
+# compression.py
+# Сжатие открытых данных перед шифрованием (шифротекст уже не сжимается). Поток делится на порции
+# по COMPRESSION_CHUNK_SIZE байт, каждая сжимается независимо и передаётся с заголовком CHUNK_HEADER,
+# поэтому сжатие идёт по мере чтения потока, а сервер распаковывает порции по одной
+import collections
+import lzma
+import math
+import struct
+import zlib
+
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+CODECS = {'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+
+COMPRESSION_CHUNK_SIZE = 64 * 1024  # Наибольший размер порции до сжатия
+# Заголовок порции: признак сжатия и длина данных порции
+CHUNK_HEADER = struct.Struct('!B I')
+CHUNK_STORED = 0  # Порция передаётся как есть
+CHUNK_COMPRESSED = 1  # Порция сжата алгоритмом сессии
+
+# Выборка для оценки энтропии: несколько участков порции. Данные с энтропией выше ENTROPY_LIMIT бит
+# на байт (сжатые, зашифрованные, медиа) не сжимаются, на них не тратится время процессора
+ENTROPY_SAMPLES = 4
+ENTROPY_SAMPLE_SIZE = 1024
+ENTROPY_LIMIT = 7.5
+
+
+def entropy(chunk):
+    # Энтропия Шеннона выборки из порции, бит на байт
+    if len(chunk) <= ENTROPY_SAMPLES * ENTROPY_SAMPLE_SIZE:
+        sample = bytes(chunk)
+    else:
+        step = (len(chunk) - ENTROPY_SAMPLE_SIZE) // (ENTROPY_SAMPLES - 1)
+        sample = b''.join(
+            chunk[i * step:i * step + ENTROPY_SAMPLE_SIZE] for i in range(ENTROPY_SAMPLES))
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in collections.Counter(sample).values())
+
+
+def compress_chunks(codec, level, chunks):
+    # Возвращает порции с заголовками. Порция остаётся несжатой, если выборка похожа на случайные
+    # данные или сжатие не уменьшило её: порция с заголовком длиннее исходной не больше чем на заголовок
+    framed = []
+    for chunk in chunks:
+        data = None
+        if entropy(chunk) < ENTROPY_LIMIT:
+            if codec == COMPRESSION_ZLIB:
+                data = zlib.compress(chunk, -1 if level is None else level)
+            elif codec == COMPRESSION_LZMA:
+                # Целостность проверяют теги сегментов: контрольная сумма xz не нужна
+                data = lzma.compress(chunk, preset=level, check=lzma.CHECK_NONE)
+            else:
+                raise ValueError(f"Неизвестный алгоритм сжатия: {codec}")
+        if data is None or len(data) >= len(chunk):
+            framed.append(CHUNK_HEADER.pack(CHUNK_STORED, len(chunk)) + chunk)
+        else:
+            framed.append(CHUNK_HEADER.pack(CHUNK_COMPRESSED, len(data)) + data)
+    return framed
+
+
+def max_compressed_size(size):
+    # Наибольший размер потока размера size после сжатия: каждая порция может остаться несжатой
+    return size + math.ceil(size / COMPRESSION_CHUNK_SIZE) * CHUNK_HEADER.size
+
+
+def decompress_chunk(codec, data):
+    if codec == COMPRESSION_ZLIB:
+        decompressor = zlib.decompressobj()
+    elif codec == COMPRESSION_LZMA:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"неизвестный алгоритм сжатия: {codec}")
+    try:
+        # Порция не может распаковаться больше чем в COMPRESSION_CHUNK_SIZE байт
+        plain = decompressor.decompress(data, COMPRESSION_CHUNK_SIZE)
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"ошибка распаковки: {e}")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError('порция распаковывается в неверный объём данных')
+    return plain
+
+
+def decompress_chunks(codec, read, size):
+    # Распаковка потока порций длиной size байт; read(offset, length) читает его часть
+    offset = 0
+    while offset < size:
+        header = read(offset, CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            raise ValueError('заголовок порции сжатых данных обрезан')
+        kind, length = CHUNK_HEADER.unpack(header)
+        offset += CHUNK_HEADER.size
+        if length > COMPRESSION_CHUNK_SIZE or kind not in (CHUNK_STORED, CHUNK_COMPRESSED):
+            raise ValueError('неверный заголовок порции сжатых данных')
+        data = read(offset, length)
+        if len(data) < length:
+            raise ValueError('порция сжатых данных обрезана')
+        offset += length
+        yield data if kind == CHUNK_STORED else decompress_chunk(codec, data)
@@ -0,0 +1,94 @@
+# crypto.py
+# Шифрование и проверка целостности пачек сегментов. Функции не зависят от состояния
+# клиента или сервера, поэтому выполняются и в пуле потоков, и в пуле процессов
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from Crypto.Cipher import AES
+
+from . import CIPHER_CTR, CIPHER_GCM, TAG_SIZE, segment_tag
+
+GCM_TAG_SIZE = 16  # Тег AES-GCM заменяет отдельный тег целостности
+
+CHECKSUM_TAG = 'tag'  # Тег BLAKE2b кадров v2
+CHECKSUM_SHA256 = 'sha256'  # SHA-256 сегментов v1
+
+
+def create_executor(kind, workers=None):
+    # kind: 'thread' — хеш и шифр отпускают GIL на время работы с буфером, 'process' — отдельные
+    # процессы, None — выполнение в потоке цикла событий
+    if kind is None:
+        return None
+    if kind == 'thread':
+        return ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix='crypto')
+    if kind == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    raise ValueError(f"Неизвестный тип исполнителя: {kind}")
+
+
+async def run_in_executor(executor, function, *args):
+    if executor is None:
+        return function(*args)
+    if isinstance(executor, ProcessPoolExecutor):
+        # В другой процесс memoryview не передать: пачка копируется
+        args = [[bytes(item) for item in arg] if isinstance(arg, list) else arg for arg in args]
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+def gcm_nonce(nonce, segment_number):
+    # Уникальный для сессии одноразовый номер: случайная часть сессии и номер сегмента
+    return nonce[:8] + segment_number.to_bytes(8, 'big')
+
+
+def encrypt_segments(key, nonce, cipher, segment_size, first, segments, outputs=None, checksum=CHECKSUM_TAG):
+    # Шифрует подряд идущие сегменты; outputs — буферы для шифротекста (только в пределах процесса).
+    # Возвращает шифротексты и их теги целостности
+    encrypted, tags = [], []
+    for i, segment in enumerate(segments):
+        segment_number = first + i
+        output = outputs[i] if outputs is not None else None
+        if cipher == CIPHER_GCM:
+            aead = AES.new(key, AES.MODE_GCM, nonce=gcm_nonce(nonce, segment_number), mac_len=GCM_TAG_SIZE)
+            data = aead.encrypt(segment, output=output)
+            tags.append(aead.digest())
+        else:
+            initial_value = segment_number * segment_size // AES.block_size  # Номер первого блока сегмента
+            ctr = AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=initial_value)
+            data = ctr.encrypt(segment, output=output)
+            if checksum == CHECKSUM_SHA256:
+                tags.append(hashlib.sha256(data if output is None else output).digest())
+            else:
+                tags.append(segment_tag(key, segment_number, data if output is None else output))
+        encrypted.append(data if output is None else output)
+    return encrypted, tags
+
+
+def decrypt_segments(key, iv, cipher, segment_size, first, segments, tags=None, tag_size=TAG_SIZE):
+    # Проверяет теги (если переданы) и расшифровывает подряд идущие сегменты.
+    # Вместо сегмента с неверным тегом возвращается None. Сегменты CBC возвращаются
+    # как есть: их расшифровывает SessionFile при завершении сессии
+    plaintexts = []
+    for i, data in enumerate(segments):
+        segment_number = first + i
+        if cipher == CIPHER_GCM:
+            aead = AES.new(key, AES.MODE_GCM, nonce=gcm_nonce(iv, segment_number), mac_len=tag_size)
+            if tags is None:
+                plaintexts.append(aead.decrypt(data))  # Сегмент, восстановленный по проверенной чётности
+                continue
+            try:
+                plaintexts.append(aead.decrypt_and_verify(data, tags[i]))
+            except ValueError:
+                plaintexts.append(None)
+            continue
+        if tags is not None and not hmac.compare_digest(tags[i], segment_tag(key, segment_number, data, tag_size)):
+            plaintexts.append(None)
+            continue
+        if cipher == CIPHER_CTR:
+            # Счётчик сегмента вычисляется из его смещения
+            initial_value = int.from_bytes(iv[8:], 'big') + segment_number * segment_size // AES.block_size
+            data = AES.new(key, AES.MODE_CTR, nonce=iv[:8], initial_value=initial_value).decrypt(data)
+        plaintexts.append(data)
+    return plaintexts
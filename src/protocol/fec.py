@@ -0,0 +1,32 @@
+# fec.py
+# Упреждающая коррекция ошибок: один сегмент чётности (XOR) на блок из block_size сегментов.
+# Позволяет серверу восстановить один потерянный или повреждённый сегмент блока без повторной передачи
+from . import FEC_PARITY, PARITY_TAG_OFFSET, TAG_SIZE, segment_tag
+
+
+def xor_segments(segments):
+    # XOR сегментов разной длины: короткие дополняются нулями (little-endian — нули в конце)
+    parity = 0
+    for segment in segments:
+        parity ^= int.from_bytes(segment, 'little')
+    return parity
+
+
+def parity_tag(key, block_first, data, size=TAG_SIZE):
+    return segment_tag(key, PARITY_TAG_OFFSET + block_first, data, size)
+
+
+def encode_parity(key, first, block_size, segments):
+    # Записи чётности для подряд идущих зашифрованных сегментов, first кратен block_size.
+    # Возвращает данные записей и их теги
+    parities, tags = [], []
+    for offset in range(0, len(segments), block_size):
+        block = segments[offset:offset + block_size]
+        lengths = 0
+        for segment in block:
+            lengths ^= len(segment)
+        size = max(len(segment) for segment in block)
+        data = FEC_PARITY.pack(len(block), lengths) + xor_segments(block).to_bytes(size, 'little')
+        parities.append(data)
+        tags.append(parity_tag(key, first + offset, data))
+    return parities, tags
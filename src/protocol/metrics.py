@@ -0,0 +1,195 @@
+# metrics.py
+# Счётчики, гистограммы и выборочная трассировка сегментов клиента и сервера вместо журнала
+# каждого сегмента. Обновление — операция со словарём без форматирования строк; снимок
+# и текстовое представление строятся только по запросу
+import asyncio
+import bisect
+import collections
+import json
+import logging
+import time
+
+# Границы корзин гистограмм задержек, сек: от 100 мкс до 100 сек, четыре корзины на порядок
+LATENCY_BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-16, 9))
+TRACE_SIZE = 4096  # Сколько последних событий трассировки хранится
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets  # Верхние границы корзин; последняя корзина — значения больше всех границ
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        # Оценка сверху: граница корзины, в которую попадает значение с рангом fraction
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def cumulative(self):
+        # (граница, число значений не больше неё) для каждой корзины
+        seen = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            result.append((bound, seen))
+        return result
+
+    def snapshot(self):
+        return {
+            'count': self.count, 'sum': self.sum,
+            'p50': self.quantile(0.50), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+        }
+
+
+class Metrics:
+    # Ряд метрики — имя и метки: кортеж пар (имя метки, значение), например (('channel', 'Channel1'),).
+    # Ряды сессии удаляются методом forget после её завершения, поэтому память не растёт с числом сессий
+    def __init__(self, prefix, trace_rate=0.0, trace_size=TRACE_SIZE):
+        self.prefix = prefix  # Префикс имён в текстовом представлении: client, server
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.gauges = {}  # (имя, метки) -> функция, вычисляющая значение при снимке
+        self.series = collections.defaultdict(set)  # метки -> ключи рядов с ними
+        # Доля трассируемых сегментов: выборка детерминирована по (сессия, сегмент),
+        # поэтому клиент и сервер с одинаковой долей трассируют одни и те же сегменты
+        self.trace_threshold = int(trace_rate * (1 << 32))
+        self.trace = collections.deque(maxlen=trace_size)  # (время, событие, сессия, сегмент, канал)
+        self.started_at = time.time()
+
+    def count(self, name, labels=(), value=1):
+        key = name, labels
+        if key in self.counters:
+            self.counters[key] += value
+        else:
+            self.counters[key] = value
+            self.series[labels].add(key)
+
+    def observe(self, name, labels, value):
+        key = name, labels
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+            self.series[labels].add(key)
+        histogram.observe(value)
+
+    def gauge(self, name, labels, function):
+        self.gauges[name, labels] = function
+        self.series[labels].add((name, labels))
+
+    def forget(self, labels):
+        # Удаление всех рядов с данными метками (например, завершённой сессии)
+        for key in self.series.pop(labels, ()):
+            self.counters.pop(key, None)
+            self.histograms.pop(key, None)
+            self.gauges.pop(key, None)
+
+    def value(self, name, labels=()):
+        return self.counters.get((name, labels), 0)
+
+    def sampled(self, session_id, segment_number):
+        if not self.trace_threshold:
+            return False
+        # Перемешивание номера сессии и сегмента (мультипликативный хеш), младшие 32 бита
+        value = ((session_id * 0x9E3779B1) ^ segment_number) * 0x85EBCA6B & 0xFFFFFFFF
+        return (value ^ value >> 16) < self.trace_threshold
+
+    def trace_segments(self, event, session_id, segment_numbers, channel=None):
+        # Событие жизненного цикла для попавших в выборку сегментов из segment_numbers
+        if not self.trace_threshold:
+            return
+        now = time.time()
+        for segment_number in segment_numbers:
+            if self.sampled(session_id, segment_number):
+                self.trace.append((now, event, session_id, segment_number, channel))
+
+    def snapshot(self):
+        # Текущие значения всех рядов: {'counters': {имя: [{'labels': ..., 'value': ...}]}, ...}
+        result = {'uptime_s': time.time() - self.started_at, 'counters': {}, 'gauges': {}, 'histograms': {}}
+        for (name, labels), value in sorted(self.counters.items(), key=str):
+            result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), function in sorted(self.gauges.items(), key=str):
+            result['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': function()})
+        for (name, labels), histogram in sorted(self.histograms.items(), key=str):
+            result['histograms'].setdefault(name, []).append(dict(histogram.snapshot(), labels=dict(labels)))
+        return result
+
+    def trace_events(self):
+        return [
+            {'time': at, 'event': event, 'session': session_id, 'segment': segment_number, 'channel': channel}
+            for at, event, session_id, segment_number, channel in self.trace
+        ]
+
+    def render(self):
+        # Текстовый формат экспозиции Prometheus
+        lines = []
+
+        def series(name, labels, value, extra=()):
+            pairs = ','.join(f'{key}="{label}"' for key, label in (*labels, *extra))
+            lines.append(f"{self.prefix}_{name}{{{pairs}}} {value}" if pairs else f"{self.prefix}_{name} {value}")
+
+        def grouped(items):
+            groups = collections.defaultdict(list)
+            for (name, labels), value in sorted(items, key=lambda item: str(item[0])):
+                groups[name].append((labels, value))
+            return sorted(groups.items())
+
+        for name, rows in grouped(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} counter")
+            for labels, value in rows:
+                series(name, labels, value)
+        for name, rows in grouped(self.gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            for labels, function in rows:
+                series(name, labels, function())
+        for name, rows in grouped(self.histograms.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} histogram")
+            for labels, histogram in rows:
+                for bound, seen in histogram.cumulative():
+                    series(f'{name}_bucket', labels, seen, (('le', f'{bound:.6g}'),))
+                series(f'{name}_bucket', labels, histogram.count, (('le', '+Inf'),))
+                series(f'{name}_sum', labels, histogram.sum)
+                series(f'{name}_count', labels, histogram.count)
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(metrics, host='127.0.0.1', port=9100):
+    # Локальная HTTP-точка: /metrics — текстовый формат Prometheus, /snapshot — снимок в JSON,
+    # /trace — события трассировки в JSON. Возвращает asyncio.Server
+    routes = {
+        '/metrics': ('text/plain; version=0.0.4', lambda: metrics.render()),
+        '/snapshot': ('application/json', lambda: json.dumps(metrics.snapshot(), ensure_ascii=False)),
+        '/trace': ('application/json', lambda: json.dumps(metrics.trace_events(), ensure_ascii=False)),
+    }
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5.0)
+            parts = request.split(b' ', 2)
+            path = parts[1].decode('latin-1').split('?', 1)[0] if len(parts) > 2 else ''
+            if path in routes:
+                content_type, body = routes[path][0], routes[path][1]().encode()
+                status = '200 OK'
+            else:
+                content_type, body, status = 'text/plain', f"{' '.join(routes)}\n".encode(), '404 Not Found'
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            logging.debug(f"Запрос метрик не обработан: {e}")
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
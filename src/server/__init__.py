@@ -1,136 +1,560 @@
 # server.py
 import asyncio
+import collections
 import hashlib
+import hmac
 import struct
 import logging
-from Crypto.Cipher import AES  # Импорт класса для шифрования AES
-from Crypto.Util.Padding import unpad  # Импорт функции для удаления дополнений
-import time
+import multiprocessing
+import os
+import signal
+
+from protocol import (
+    ACK, CIPHER_CBC, CODE_FIN, CODE_KEY, CODE_V2_DATA, CODE_WINDOWED_SEGMENT, DATA_LENGTH, FEC_PARITY, FLAG_PARITY,
+    COMPRESSION_VERSION, KEY_ACCEPTED, NACK, OPTION_CIPHER, OPTION_COMPRESSION, OPTION_FEC_BLOCK, OPTION_SEGMENT_SIZE,
+    OPTION_TOTAL_SEGMENTS, OPTION_VERSION, PROTOCOL_VERSION, SESSION_BUSY, SESSION_TOO_LARGE, V2_ACK, V2_ACK_CODE,
+    V2_BUSY_CODE, V2_ENTRY, V2_FRAME_TAIL, V2_NACK_CODE, V2_TOTAL, WINDOWED_ACK, WINDOWED_ACK_FAIL, WINDOWED_ACK_OK,
+    WINDOWED_SEGMENT_TAIL, decode_key_options, encode_key_options,
+)
+from protocol.compression import max_compressed_size
+from protocol.crypto import create_executor, decrypt_segments, run_in_executor
+from protocol.fec import parity_tag
+from protocol.metrics import Metrics, serve_metrics
+from .connection import ChannelConnection
+from .fec import ParityBlocks
+from .reassembly import LEGACY_SEGMENT_SIZE, SessionFile, read_session_key
+from .sessions import ADMITTED, BUSY, CHARGED, CONFLICT, SERVER_BUSY, SESSION_LIMIT, TOO_LARGE, SessionManager
 
 # Настройка базового логирования на уровне INFO
 logging.basicConfig(level=logging.INFO)
 
+# Ответы на отклонённый KEY и их причины в журнале
+KEY_REJECTIONS = {
+    BUSY: (SESSION_BUSY, 'сервер перегружен'),
+    CONFLICT: (NACK, 'идентификатор занят'),
+    TOO_LARGE: (SESSION_TOO_LARGE, 'объём сессии больше допустимого'),
+}
+
+# Как часто рабочий процесс проверяет, не завершили ли его общие сессии другие процессы, сек
+STALE_CHECK_INTERVAL = 1.0
+
 class AggregatedServer:
-    def __init__(self, channels):
+    def __init__(self, channels, storage_dir='.', crypto_executor='thread', crypto_workers=None,
+                 max_sessions=1024, max_session_bytes=1 << 30, max_total_bytes=8 << 30, session_ttl=60.0,
+                 shared=False, metrics_port=None, trace_rate=0.0, log_segments=False):
         self.channels = channels  # Список каналов для запуска серверов
-        self.session_data = {}  # Хранение данных сессий
-        self.locks = {}  # Хранение блокировок для сессий
+        self.storage_dir = storage_dir  # Каталог для файлов сессий
+        # Таблица сессий с ограничением их числа и объёма данных; сессии без кадров дольше
+        # session_ttl секунд удаляются вместе с недособранными файлами
+        self.sessions = SessionManager(max_sessions, max_session_bytes, max_total_bytes, session_ttl)
         self.retransmission_limit = 3  # Лимит на количество повторных передач
+        self.tasks = set()  # Фоновые задачи завершения сессий
+        # Проверка тегов и расшифровка кадров v2 выполняются вне цикла событий: 'thread', 'process' или None
+        self.crypto_executor = create_executor(crypto_executor, crypto_workers)
+        # Сервер — один из рабочих процессов run_workers: порты каналов открыты во всех процессах
+        # (SO_REUSEPORT), а сессии собираются в общих файлах storage_dir. Ограничения сессий действуют
+        # в каждом процессе отдельно
+        self.shared = shared
+        # Счётчики и гистограммы каналов и сессий вместо журнала каждого сегмента: доступны через
+        # metrics.snapshot() или локальную HTTP-точку на metrics_port (None — без неё). trace_rate — доля
+        # сегментов, события которых попадают в трассировку; log_segments включает журнал сегментов
+        self.metrics = Metrics('server', trace_rate)
+        self.metrics_port = metrics_port
+        self.log_segments = log_segments
+        self.connections = collections.defaultdict(set)  # Открытые соединения по имени канала
+        self.metrics.gauge('sessions', (), lambda: len(self.sessions))
+        self.metrics.gauge('session_bytes', (), lambda: self.sessions.total_bytes)
+        for channel in channels:
+            self._register_channel_gauges(channel['name'])
+
+    def _register_channel_gauges(self, name):
+        labels = (('channel', name),)
+        connections = self.connections[name]
+        self.metrics.gauge('connections', labels, lambda: len(connections))
+        # Принятые, но ещё не обработанные байты: очередь кадров канала на сервере
+        self.metrics.gauge('buffered_bytes', labels, lambda: sum(c.end - c.start for c in connections))
 
     async def start_servers(self):
         servers = []  # Список для хранения созданных серверов
+        loop = asyncio.get_running_loop()
+        eviction = asyncio.create_task(self.evict_idle_sessions())  # Удаление простаивающих сессий
+        self.tasks.add(eviction)
+        eviction.add_done_callback(self.tasks.discard)
+        if self.shared:
+            sweep = asyncio.create_task(self.sweep_stale_sessions())  # Удаление сессий, завершённых другими процессами
+            self.tasks.add(sweep)
+            sweep.add_done_callback(self.tasks.discard)
+        if self.metrics_port is not None:
+            await serve_metrics(self.metrics, port=self.metrics_port)
+            logging.info(f"Метрики доступны на http://127.0.0.1:{self.metrics_port}/metrics")
         for channel in self.channels:
             # Запуск сервера для каждого канала
-            server = await asyncio.start_server(
-                self.handle_client,  # Функция для обработки клиентов
+            server = await loop.create_server(
+                # Протокол, разбирающий кадры в буфере приёма
+                lambda name=channel['name']: ChannelConnection(self, name),
                 channel['host'],  # Хост сервера
-                channel['port']   # Порт сервера
+                channel['port'],  # Порт сервера
+                reuse_port=self.shared,  # Ядро распределяет соединения между рабочими процессами
             )
             servers.append(server)  # Добавление сервера в список
             logging.info(f"Сервер запущен на {channel['host']}:{channel['port']} ({channel['name']})")
         # Запуск всех серверов и ожидание их работы
         await asyncio.gather(*(server.serve_forever() for server in servers))
 
-    async def handle_client(self, reader, writer):
-        session_start_time = time.time()  # Время начала сессии
+    def handle_frame(self, session_id, code, header, payload, transport):
+        # header и payload — срезы буфера приёма, действительные только во время вызова
+        if code == CODE_KEY:
+            # Обработка ключа шифрования
+            key, iv = bytes(payload[:16]), bytes(payload[16:32])  # Разделение на ключ и IV
+            options = decode_key_options(payload[32:])  # Параметры сессии (у клиентов v1 их нет)
+            status = self.store_encryption_key(session_id, key, iv, options)  # Сохранение ключа
+            self.metrics.count('keys_received')
+            if status != ADMITTED:
+                self.metrics.count('keys_rejected')
+                # Сервер перегружен, идентификатор занят другой сессией или сессия слишком велика
+                reply, reason = KEY_REJECTIONS[status]
+                transport.write(reply)
+                logging.warning(f"[Сессия {session_id}] Ключ отклонён: {reason}")
+                return
+            if OPTION_VERSION in options:
+                # Клиент предлагает версию протокола: отвечаем наибольшей общей
+                version = min(options[OPTION_VERSION], PROTOCOL_VERSION)
+                transport.write(KEY_ACCEPTED + bytes([version]))
+            else:
+                transport.write(ACK)  # Подтверждение получения ключа
+            logging.info(f"[Сессия {session_id}] Ключ шифрования получен")
+        elif code == CODE_FIN:
+            # Обработка сигнала о завершении передачи
+            if len(payload) == V2_TOTAL.size:
+                self.handle_counted_fin(session_id, V2_TOTAL.unpack(payload)[0], transport, version=2)
+            elif payload:
+                # Оконный режим: клиент сообщает общее число сегментов и ждёт
+                # кумулятивного подтверждения
+                self.handle_counted_fin(session_id, DATA_LENGTH.unpack(payload)[0], transport, version=1)
+            else:
+                transport.write(ACK)  # Подтверждение окончания передачи
+                self.schedule_finalize(session_id)  # Завершение сессии
+        elif code == CODE_V2_DATA:
+            transport.writelines(self.receive_v2_frame(session_id, header, payload))
+        elif code == CODE_WINDOWED_SEGMENT:
+            # Сегмент оконного режима: на каждый сегмент отвечаем статусом
+            # и кумулятивным подтверждением, не дожидаясь следующих
+            segment_number, checksum = WINDOWED_SEGMENT_TAIL.unpack(header)
+            stored, cumulative = self.receive_segment(session_id, segment_number, checksum, payload)
+            status = WINDOWED_ACK_OK if stored else WINDOWED_ACK_FAIL
+            transport.write(WINDOWED_ACK.pack(status, segment_number, cumulative))
+        else:
+            # Сегмент данных v1: вместо кода передаётся номер сегмента
+            segment_number = struct.unpack('!I', code)[0]  # Получение номера сегмента
+            stored, _ = self.receive_segment(session_id, segment_number, header, payload)
+            transport.write(ACK if stored else NACK)  # Подтверждение или отклонение сегмента
+
+    def offloads(self, code):
+        # Кадры, обрабатываемые в исполнителе; соединение не разбирает следующие кадры до их завершения
+        return code == CODE_V2_DATA and self.crypto_executor is not None
+
+    async def handle_frame_async(self, session_id, code, header, payload):
+        # Возвращает буферы ответа: соединение записывает их в порядке кадров
+        session, flags, first, segments, tags, tag_size = self.parse_v2_frame(session_id, header, payload)
+        if flags & FLAG_PARITY:
+            return self.receive_parity_frame(session_id, session, first, segments, tags, tag_size)
+        plaintexts = [None] * len(segments)
+        if session is not None:
+            session_file = session['file']
+            plaintexts = await run_in_executor(
+                self.crypto_executor, decrypt_segments, session_file.key, session_file.iv, session_file.cipher,
+                session_file.segment_size, first, segments, tags, tag_size)
+        return self.store_v2_segments(session_id, first, segments, plaintexts)
+
+    def receive_segment(self, session_id, segment_number, checksum, data):
+        session = self.lookup_session(session_id)
+        if session is None or hashlib.sha256(data).digest() != checksum:  # Проверка контрольной суммы
+            self.count_segments('rejected', session_id, session, [segment_number])
+            logging.warning(f"[Сессия {session_id}] Ошибка контрольной суммы в сегменте {segment_number}")
+            return False, session['file'].contiguous if session else 0
+        session_file = session['file']
+        data = decrypt_segments(
+            session_file.key, session_file.iv, session_file.cipher, session_file.segment_size, segment_number, [data])[0]
+        if self.store_segment(session_id, segment_number, data) != CHARGED:  # Сохранение сегмента
+            return False, session_file.contiguous
+        self.count_segments('stored', session_id, session, [segment_number])
+        if self.log_segments:
+            logging.info(f"[Сессия {session_id}] Получен сегмент {segment_number}")
+        return True, session_file.contiguous
+
+    def receive_v2_frame(self, session_id, header, payload):
+        # Кадр v2: несколько подряд идущих сегментов, у каждого свой тег целостности.
+        # Ответ — кумулятивное подтверждение и битовая карта сохранённых сегментов кадра
+        session, flags, first, segments, tags, tag_size = self.parse_v2_frame(session_id, header, payload)
+        if flags & FLAG_PARITY:
+            return self.receive_parity_frame(session_id, session, first, segments, tags, tag_size)
+        plaintexts = [None] * len(segments)
+        if session is not None:
+            session_file = session['file']
+            plaintexts = decrypt_segments(
+                session_file.key, session_file.iv, session_file.cipher, session_file.segment_size,
+                first, segments, tags, tag_size)
+        return self.store_v2_segments(session_id, first, segments, plaintexts)
+
+    def parse_v2_frame(self, session_id, header, payload):
+        flags, tag_size, count, first, total_segments = V2_FRAME_TAIL.unpack(header)
+        session = self.lookup_session(session_id)
+        if session is not None and total_segments:
+            self.reserve_session(session, total_segments)
+        segments, tags = [], []
+        position = 0
+        for _ in range(count):
+            length = V2_ENTRY.unpack_from(payload, position)[0]
+            position += V2_ENTRY.size
+            tags.append(payload[position:position + tag_size])
+            segments.append(payload[position + tag_size:position + tag_size + length])
+            position += tag_size + length
+        return session, flags, first, segments, tags, tag_size
+
+    def store_v2_segments(self, session_id, first, segments, plaintexts):
+        # Сессию могли завершить или удалить, пока кадр обрабатывался в исполнителе
+        session = self.lookup_session(session_id)
+        count = len(plaintexts)
+        bitmap = bytearray((count + 7) // 8)
+        fresh = []  # Впервые полученные сегменты кадра
+        rejected = []  # Сегменты с ошибкой тега или неизвестной сессии
+        stored = []
+        busy = False
+        for i, data in enumerate(plaintexts):
+            if session is None or data is None:
+                rejected.append(first + i)
+                continue
+            is_fresh = session['parity'] is not None and not session['file'].has_segment(first + i)
+            status = self.store_segment(session_id, first + i, data)  # Сохранение сегмента
+            if status != CHARGED:
+                busy = busy or status == SERVER_BUSY
+                continue
+            if is_fresh:
+                fresh.append(i)
+            stored.append(first + i)
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+        for i in fresh:
+            # Зашифрованный сегмент учитывается в чётности своего блока уже после сохранения
+            # всего кадра, чтобы не восстанавливать сегменты, пришедшие в нём же
+            recovered = session['parity'].add_segment(first + i, segments[i])
+            if recovered and self.store_recovered_segment(session_id, session, *recovered):
+                j = recovered[0] - first
+                if 0 <= j < count:
+                    bitmap[j >> 3] |= 0x80 >> (j & 7)  # Повреждённый сегмент этого же кадра восстановлен
+        self.count_segments('stored', session_id, session, stored)
+        if rejected:
+            self.count_segments('rejected', session_id, session, rejected)
+            logging.warning(f"[Сессия {session_id}] Ошибка тега целостности в сегментах {rejected}")
+        if self.log_segments:
+            logging.info(f"[Сессия {session_id}] Получены сегменты {first}-{first + count - 1}")
+        cumulative = session['file'].contiguous if session else 0
+        if session and session['parity'] is not None:
+            session['parity'].prune(cumulative)
+        # При нехватке общего объёма клиент повторит непринятые сегменты с паузой
+        return [V2_ACK.pack(V2_BUSY_CODE if busy else V2_ACK_CODE, cumulative, first, count), bitmap]
+
+    def receive_parity_frame(self, session_id, session, first, parities, tags, tag_size):
+        # Ответ — битовая карта сегментов, восстановленных по чётности, от first до конца последнего блока
+        recovered = []
+        start = first
+        for data, tag in zip(parities, tags):
+            count, lengths = FEC_PARITY.unpack_from(data)
+            if session is None or session['parity'] is None or not hmac.compare_digest(
+                    tag, parity_tag(session['file'].key, start, data, tag_size)):
+                self.metrics.count('parity_rejected')
+                logging.warning(f"[Сессия {session_id}] Ошибка тега чётности блока {start}")
+            elif not all(session['file'].has_segment(n) for n in range(start, start + count)):
+                result = session['parity'].add_parity(start, count, lengths, data[FEC_PARITY.size:])
+                if result and self.store_recovered_segment(session_id, session, *result):
+                    recovered.append(result[0] - first)
+            start += count
+        covered = start - first
+        bitmap = bytearray((covered + 7) // 8)
+        for i in recovered:
+            bitmap[i >> 3] |= 0x80 >> (i & 7)
+        cumulative = session['file'].contiguous if session else 0
+        return [V2_ACK.pack(V2_ACK_CODE, cumulative, first, covered), bitmap]
+
+    def store_recovered_segment(self, session_id, session, segment_number, data):
+        # Восстановленный сегмент зашифрован, его целостность следует из проверенных тегов блока
+        session_file = session['file']
+        if session_file.has_segment(segment_number):
+            return False
+        data = decrypt_segments(
+            session_file.key, session_file.iv, session_file.cipher, session_file.segment_size, segment_number, [data])[0]
+        if self.store_segment(session_id, segment_number, data) != CHARGED:
+            return False
+        self.count_segments('recovered', session_id, session, [segment_number])
+        if self.log_segments:
+            logging.info(f"[Сессия {session_id}] Сегмент {segment_number} восстановлен по чётности")
+        return True
+
+    def count_segments(self, event, session_id, session, segment_numbers):
+        # Счётчик segments_<event> сервера и сессии (если она открыта) и событие трассировки сегментов
+        if not segment_numbers:
+            return
+        name = 'segments_' + event
+        self.metrics.count(name, (), len(segment_numbers))
+        if session is not None:
+            self.metrics.count(name, (('session', session_id),), len(segment_numbers))
+        self.metrics.trace_segments(event, session_id, segment_numbers)
+
+    def reserve_session(self, session, total_segments):
+        # Общее число сегментов известно: резервируем место под файл сессии один раз
+        if session['total_segments'] is None:
+            session['total_segments'] = total_segments
+            # Место резервируется, только если объём сессии укладывается в ограничения
+            session_file = session['file']
+            if self.sessions.charge(session, total_segments * session_file.segment_size) == CHARGED:
+                session_file.preallocate(total_segments)
+
+    def store_encryption_key(self, session_id, key, iv, options=None):
+        # Возвращает ADMITTED, CONFLICT, BUSY или TOO_LARGE (см. SessionManager.open)
+        options = options or {}
+
+        def create():
+            # Данные сессии собираются сразу в файле, в памяти остаётся только состояние сборки
+            path = os.path.join(self.storage_dir, f'session_{session_id}.dat')
+            if self.shared:
+                return self.open_shared_file(path, key, iv, options)
+            return ADMITTED, SessionFile(
+                path, key, iv,
+                options.get(OPTION_CIPHER, CIPHER_CBC),  # Режим шифрования
+                options.get(OPTION_SEGMENT_SIZE),  # Размер сегмента клиента
+                compression=session_compression(options),  # Алгоритм сжатия данных
+            )
+
+        # Объём сессии известного размера учитывается при допуске, а не по мере записи. Клиент со сжатием
+        # заявляет объём несжатых данных: их ограничение проверяется при распаковке, а поток порций может
+        # превысить его на заголовки несжатых порций
+        reserve = options.get(OPTION_TOTAL_SEGMENTS, 0) * options.get(OPTION_SEGMENT_SIZE, LEGACY_SEGMENT_SIZE)
+        limit = max_compressed_size(self.sessions.max_session_bytes) if session_compression(options) else None
+        # Повторный KEY не должен вернуть сессию, завершённую другим процессом
+        self.drop_stale_session(session_id, self.sessions.sessions.get(session_id))
+        status, session = self.sessions.open(session_id, key, iv, create, reserve, limit)
+        if status == BUSY and self.drop_stale_sessions():
+            status, session = self.sessions.open(session_id, key, iv, create, reserve, limit)
+        if session is not None and session['parity'] is None and options.get(OPTION_FEC_BLOCK):
+            # Накопители чётности блоков, если клиент передаёт сегменты чётности
+            session['parity'] = ParityBlocks(options[OPTION_FEC_BLOCK])
+        return status
 
+    def open_shared_file(self, path, key, iv, options):
+        # Файлы сессии создаёт процесс, первым создавший файл её параметров (O_EXCL): он записывает
+        # параметры последними, и остальные процессы присоединяются к уже созданным файлам
+        cipher, segment_size = options.get(OPTION_CIPHER, CIPHER_CBC), options.get(OPTION_SEGMENT_SIZE)
+        compression = session_compression(options)
         try:
-            while True:
-                # Чтение заголовка сообщения
-                header = await reader.readexactly(4 + 4)
-                session_id, code = struct.unpack('!I 4s', header)  # Распаковка заголовка
-                code = str(code.decode('utf-8')).replace("\x00", "")  # Очистка кода
-
-                if code == 'KEY':
-                    # Обработка ключа шифрования
-                    data_length_bytes = await reader.readexactly(4)
-                    data_length = struct.unpack('!I', data_length_bytes)[0]
-                    key_iv = await reader.readexactly(data_length)  # Чтение ключа и IV
-                    key, iv = key_iv[:16], key_iv[16:]  # Разделение на ключ и IV
-                    self.store_encryption_key(session_id, key, iv)  # Сохранение ключа
-                    writer.write(b'ACK')  # Подтверждение получения ключа
-                    await writer.drain()  # Ожидание завершения записи
-                    logging.info(f"[Сессия {session_id}] Ключ шифрования получен")
-                elif code == 'FIN':
-                    # Обработка сигнала о завершении передачи
-                    writer.write(b'ACK')  # Подтверждение окончания передачи
-                    await writer.drain()  # Ожидание завершения записи
-                    await self.finalize_session(session_id)  # Завершение сессии
-                    logging.info(f"[Сессия {session_id}] Передача завершена")
-                    break  # Выход из цикла
-                else:
-                    # Обработка сегмента данных
-                    segment_number = ord(code)  # Получение номера сегмента
-                    checksum = await reader.readexactly(32)  # Чтение контрольной суммы
-                    data_length_bytes = await reader.readexactly(4)  # Чтение длины данных
-                    data_length = struct.unpack('!I', data_length_bytes)[0]
-                    data = await reader.readexactly(data_length)  # Чтение самого сегмента данных
-                    if hashlib.sha256(data).digest() == checksum:  # Проверка контрольной суммы
-                        writer.write(b'ACK')  # Подтверждение получения
-                        await writer.drain()  # Ожидание завершения записи
-                        await self.store_segment(session_id, segment_number, data)  # Сохранение сегмента
-                        logging.info(f"[Сессия {session_id}] Получен сегмент {segment_number}")
-                    else:
-                        writer.write(b'NACK')  # Отклонение сегмента
-                        await writer.drain()  # Ожидание завершения записи
-                        logging.warning(f"[Сессия {session_id}] Ошибка контрольной суммы в сегменте {segment_number}")
-        except asyncio.IncompleteReadError:
-            pass  # Клиент закрыл соединение
-        except Exception as e:
-            logging.error(f"Ошибка при обработке клиента: {e}")  # Логирование ошибок
+            fd = os.open(path + '.key', os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            published = read_session_key(path)
+            if published is None:
+                return BUSY, None  # Параметры ещё записываются: клиент повторит KEY
+            if published[:32] != key + iv:
+                return CONFLICT, None
+            try:
+                return ADMITTED, SessionFile(
+                    path, key, iv, cipher, segment_size, shared=True, create=False, compression=compression)
+            except FileNotFoundError:
+                return BUSY, None  # Сессию завершает другой процесс
+        try:
+            session_file = SessionFile(path, key, iv, cipher, segment_size, shared=True, compression=compression)
+            os.write(fd, key + iv + encode_key_options(options))
+        except OSError:
+            os.unlink(path + '.key')
+            raise
         finally:
-            writer.close()  # Закрытие соединения
-            await writer.wait_closed()  # Ожидание закрытия
+            os.close(fd)
+        return ADMITTED, session_file
 
-        session_end_time = time.time()  # Время окончания сессии
-        logging.info(
-            f"[Сессия {session_id}] Обработка клиента завершена. Время сессии: {session_end_time - session_start_time:.2f} сек")
+    def lookup_session(self, session_id):
+        # Кадры общей сессии приходят и в процессы, не получавшие её KEY: они присоединяются к сессии
+        # по записанным параметрам
+        session = self.drop_stale_session(session_id, self.sessions.get(session_id))
+        if session is None and self.shared:
+            payload = read_session_key(os.path.join(self.storage_dir, f'session_{session_id}.dat'))
+            if payload is not None and self.store_encryption_key(
+                    session_id, payload[:16], payload[16:32], decode_key_options(payload[32:])) == ADMITTED:
+                session = self.sessions.get(session_id)
+        return session
 
-    def store_encryption_key(self, session_id, key, iv):
-        if session_id not in self.session_data:  # Если сессия новая
-            self.session_data[session_id] = {'segments': {}, 'key': key, 'iv': iv, 'total_segments': None}  # Инициализация данных сессии
-            self.locks[session_id] = asyncio.Lock()  # Инициализация блокировки
-        else:
-            # Обновление ключа и IV для существующей сессии
-            self.session_data[session_id]['key'] = key
-            self.session_data[session_id]['iv'] = iv
+    def drop_stale_session(self, session_id, session):
+        # Общую сессию мог завершить другой рабочий процесс: её файл сборки переименован или пересоздан.
+        # Такая сессия удаляется, не дожидаясь ttl, вместе с открытыми файлами, местом в таблице
+        # и учтённым объёмом, а запоздавшие кадры не пишутся в уже собранный файл. Возвращает сессию или None
+        if session is None or not self.shared or session['file'].is_current():
+            return session
+        self.sessions.remove(session_id)
+        self.metrics.forget((('session', session_id),))
+        session['file'].close()
+        logging.info(f"[Сессия {session_id}] Завершена другим рабочим процессом")
+        return None
 
-    async def store_segment(self, session_id, segment_number, data):
-        async with self.locks[session_id]:  # Захват блокировки для записи
-            self.session_data[session_id]['segments'][segment_number] = data  # Сохранение сегмента данных
+    def drop_stale_sessions(self):
+        # Возвращает число удалённых сессий, завершённых другими рабочими процессами
+        if not self.shared:
+            return 0
+        dropped = 0
+        for session_id, session in list(self.sessions.sessions.items()):
+            if self.drop_stale_session(session_id, session) is None:
+                dropped += 1
+        return dropped
 
-    async def finalize_session(self, session_id):
-        async with self.locks[session_id]:  # Захват блокировки для завершения
-            segments_data = self.session_data[session_id]['segments']  # Получение данных сегментов
-            key = self.session_data[session_id]['key']  # Получение ключа
-            iv = self.session_data[session_id]['iv']  # Получение IV
+    def store_segment(self, session_id, segment_number, data):
+        # Расшифрованный сегмент записывается по своему смещению, если позволяют ограничения объёма;
+        # возвращается CHARGED, SESSION_LIMIT или SERVER_BUSY
+        session = self.sessions.get(session_id)
+        session_file = session['file']
+        status = self.sessions.charge(session, segment_number * session_file.segment_size + len(data))
+        if status == SERVER_BUSY and self.drop_stale_sessions():
+            status = self.sessions.charge(session, segment_number * session_file.segment_size + len(data))
+        if status == CHARGED:
+            session_file.write_segment(segment_number, data)
+        elif status == SESSION_LIMIT:
+            logging.warning(f"[Сессия {session_id}] Сегмент {segment_number} превышает допустимый объём сессии")
+        return status
+
+    def handle_counted_fin(self, session_id, total_segments, transport, version):
+        # FIN с общим числом сегментов: сессия завершается, только если получены все
+        def reply(complete, cumulative):
+            if version >= 2:
+                transport.write(V2_ACK.pack(V2_ACK_CODE if complete else V2_NACK_CODE, cumulative, total_segments, 0))
+            else:
+                status = WINDOWED_ACK_OK if complete else WINDOWED_ACK_FAIL
+                transport.write(WINDOWED_ACK.pack(status, total_segments, cumulative))
 
-            # Собираем все сегменты в правильном порядке
-            total_segments = len(segments_data)  # Общее количество сегментов
-            full_data_encrypted = b''.join(segments_data[i] for i in range(total_segments))  # Сборка сегментов в одно зашифрованное сообщение
+        session = self.lookup_session(session_id)
+        if session is None:
+            # Сессию уже завершил FIN, пришедший по другому каналу, или другой рабочий процесс. Иначе она
+            # удалена по ttl вместе с недособранным файлом: подтверждение означало бы потерю данных
+            if self.sessions.is_finished(session_id) or self.finished_elsewhere(session_id):
+                reply(True, total_segments)
+                return
+            reply(False, 0)
+            self.metrics.count('fin_unknown')
+            logging.error(f"[Сессия {session_id}] FIN неизвестной или удалённой по ttl сессии")
+            return
+        session['total_segments'] = total_segments
+        cumulative = session['file'].contiguous
+        if cumulative < total_segments:
+            # Получены не все сегменты: сессию не завершаем, клиент может дослать недостающие
+            reply(False, cumulative)
+            self.metrics.count('fin_incomplete')
+            logging.error(f"[Сессия {session_id}] FIN до получения всех сегментов: {cumulative}/{total_segments}")
+            return
+        reply(True, cumulative)
+        self.schedule_finalize(session_id)  # Завершение сессии
 
-            # Расшифровка данных
-            cipher = AES.new(key, AES.MODE_CBC, iv)  # Инициализация шифра
+    def finished_elsewhere(self, session_id):
+        # Общую сессию завершает процесс, первым переименовавший файл сборки: он мог ещё не закончить
+        # расшифровку и распаковку (файл .part.final) или уже собрал файл сессии
+        if not self.shared:
+            return False
+        path = os.path.join(self.storage_dir, f'session_{session_id}.dat')
+        return os.path.exists(path) or os.path.exists(path + '.part.final')
+
+    def schedule_finalize(self, session_id):
+        # Ответ на FIN уже записан, поэтому порядок ответов в соединении не нарушается
+        task = asyncio.create_task(self.finalize_session(session_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def finalize_session(self, session_id):
+        # FIN может прийти по нескольким каналам (клиент повторяет его при ошибке соединения): сессию завершает первый
+        session = self.lookup_session(session_id)
+        if session is None:
+            return False
+        async with session['lock']:  # Захват блокировки для завершения
+            if self.sessions.sessions.get(session_id) is not session:
+                return False  # Сессию завершил FIN, ожидавший блокировку раньше
+            # Сессия убирается до завершения файла в отдельном потоке: запоздавшие кадры получат отказ
+            self.sessions.remove(session_id)
+            self.sessions.finish(session_id)
+            self.metrics.forget((('session', session_id),))
             try:
-                full_data = unpad(cipher.decrypt(full_data_encrypted), AES.block_size)  # Расшифровка и удаление дополнений
-                logging.info(f"[Сессия {session_id}] Все данные успешно получены и расшифрованы. Длина: {len(full_data)} байт")
-                # Обработка полученных данных (например, сохранение в файл)
-                with open(f'session_{session_id}.dat', 'wb') as f:
-                    f.write(full_data)  # Запись данных в файл
+                # Данные уже расшифрованы в файле (CBC — потоково, порциями): остаётся переименование,
+                # а для сессии со сжатием — распаковка порций
+                length = await asyncio.to_thread(session['file'].finalize, self.sessions.max_session_bytes)
+                if length is None:
+                    return False  # Сессию завершил другой рабочий процесс
+                self.metrics.count('sessions_completed')
+                self.metrics.count('bytes_completed', (), length)
+                logging.info(f"[Сессия {session_id}] Все данные успешно получены и расшифрованы. Длина: {length} байт")
             except ValueError as e:
-                logging.error(f"[Сессия {session_id}] Ошибка при расшифровке данных: {e}")  # Логирование ошибок расшифровки
+                logging.error(f"[Сессия {session_id}] Ошибка при расшифровке данных: {e}")  # Ошибки расшифровки и распаковки
+        logging.info(f"[Сессия {session_id}] Передача завершена")
+        return True
 
-            # Очищаем данные сессии после завершения
-            del self.session_data[session_id]
-            del self.locks[session_id]
+    async def evict_idle_sessions(self):
+        # Клиент может пропасть, не отправив FIN: его сессия удаляется вместе с недособранным файлом
+        while True:
+            await asyncio.sleep(self.sessions.ttl / 4)
+            for session_id, session in self.sessions.expire():
+                self.metrics.forget((('session', session_id),))
+                if self.shared and session['file'].idle_time() < self.sessions.ttl:
+                    session['file'].close()  # Кадры сессии принимают другие рабочие процессы
+                    continue
+                session['file'].discard()
+                self.metrics.count('sessions_evicted')
+                logging.warning(f"[Сессия {session_id}] Удалена: нет кадров дольше {self.sessions.ttl:.0f} сек")
 
-async def main():
-    channels = [
-        {'name': 'Channel1', 'host': '127.0.0.1', 'port': 8888},
-        {'name': 'Channel2', 'host': '127.0.0.1', 'port': 8889},
+    async def sweep_stale_sessions(self):
+        # FIN общей сессии может не прийти в процесс, получавший её кадры: сессию, завершённую другим
+        # процессом, он удаляет по исчезнувшему файлу сборки
+        while True:
+            await asyncio.sleep(STALE_CHECK_INTERVAL)
+            self.drop_stale_sessions()
+
+def session_compression(options):
+    # Сжатие действует, только если клиент и сервер согласовали версию, в которой оно есть:
+    # клиент, получивший меньшую версию, передаёт данные без сжатия
+    if min(options.get(OPTION_VERSION, 1), PROTOCOL_VERSION) >= COMPRESSION_VERSION:
+        return options.get(OPTION_COMPRESSION)
+    return None
+
+def serve_worker(channels, options):
+    asyncio.run(AggregatedServer(channels, shared=True, **options).start_servers())
+
+def run_workers(channels, workers=None, **options):
+    # Многопроцессный сервер: каждый рабочий процесс запускает все каналы со своим циклом событий,
+    # ядро распределяет между ними соединения, а сегменты одной сессии из разных процессов
+    # собираются в общих файлах. options — параметры AggregatedServer
+    # Локальная точка метрик у каждого рабочего процесса своя: metrics_port + номер процесса
+    metrics_port = options.pop('metrics_port', None)
+    processes = [
+        multiprocessing.Process(target=serve_worker, name=f'worker-{i}', args=(
+            channels, dict(options, metrics_port=None if metrics_port is None else metrics_port + i)))
+        for i in range(workers or os.cpu_count())
     ]
-    server = AggregatedServer(channels)
-    await server.start_servers()
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        raise SystemExit(128 + signum)
 
-if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    # SIGTERM и SIGINT родителя останавливают и рабочие процессы: иначе они продолжают держать порты
+    # каналов. SIGINT, как обычно, прерывает работу через KeyboardInterrupt. Обработчики ставятся
+    # после запуска процессов, которые наследуют обычные
+    previous = {
+        signal.SIGTERM: signal.signal(signal.SIGTERM, stop),
+        signal.SIGINT: signal.signal(signal.SIGINT, signal.default_int_handler),
+    }
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+CHANNELS = [
+    {'name': 'Channel1', 'host': '127.0.0.1', 'port': 8888},
+    {'name': 'Channel2', 'host': '127.0.0.1', 'port': 8889},
+]
+
+async def main():
+    server = AggregatedServer(CHANNELS)
+    await server.start_servers()
@@ -0,0 +1,11 @@
+# python -m server [число рабочих процессов]
+import asyncio
+import sys
+
+from . import CHANNELS, main, run_workers
+
+workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+if workers > 1:
+    run_workers(CHANNELS, workers)  # Рабочие процессы делят порты каналов
+else:
+    asyncio.run(main())  # Запуск серверов по всем каналам
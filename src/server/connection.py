@@ -0,0 +1,172 @@
+# connection.py
+# Приём кадров канала без лишних копий: данные читаются в переиспользуемый буфер
+# и разбираются прямо в нём срезами memoryview
+import asyncio
+import logging
+import time
+
+from protocol import (
+    CODE_FIN, CODE_KEY, CODE_V2_DATA, CODE_WINDOWED_SEGMENT, DATA_LENGTH, FRAME_HEADER, V2_FRAME_TAIL,
+    WINDOWED_SEGMENT_TAIL,
+)
+
+RECEIVE_BUFFER_SIZE = 256 * 1024  # Начальный размер буфера приёма
+MIN_FREE_SPACE = 16 * 1024  # Меньше свободного места в конце буфера — освобождаем место
+LEGACY_CHECKSUM_SIZE = 32  # SHA-256 сегмента v1
+
+# Размер части заголовка между FRAME_HEADER и полем длины данных для каждого кода
+CONTROL_HEADER_SIZES = {
+    CODE_KEY: 0,
+    CODE_FIN: 0,
+    CODE_WINDOWED_SEGMENT: WINDOWED_SEGMENT_TAIL.size,
+    CODE_V2_DATA: V2_FRAME_TAIL.size,
+}
+
+
+class ChannelConnection(asyncio.BufferedProtocol):
+    def __init__(self, server, channel_name, buffer_size=RECEIVE_BUFFER_SIZE):
+        self.server = server  # AggregatedServer, обрабатывающий разобранные кадры
+        self.channel_name = channel_name
+        self.metrics = server.metrics
+        self.labels = (('channel', channel_name),)  # Метки рядов канала в метриках сервера
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Начало первого неразобранного кадра
+        self.end = 0  # Конец принятых данных
+        self.transport = None
+        self.started_at = time.time()  # Время начала обслуживания соединения
+        self.frames_served = 0  # Количество кадров, обработанных по соединению
+        self.sessions = set()  # Сессии, кадры которых пришли по соединению
+        self.bytes_received = 0
+        self.bytes_copied = 0  # Байты, перенесённые внутри буфера при его уплотнении
+        # Кадры, обрабатываемые в исполнителе сервера: пока они не завершены, буфер не меняется
+        # и чтение приостановлено, поэтому срезы memoryview в заданиях остаются действительными
+        self.jobs_task = None
+        self.writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections[self.channel_name].add(self)
+        self.metrics.count('connections_accepted', self.labels)
+
+    def get_buffer(self, sizehint):
+        # Сокет читает прямо в свободный хвост буфера
+        if len(self.buffer) - self.end < MIN_FREE_SPACE:
+            self._make_room()
+        return self.view[self.end:]
+
+    def _make_room(self):
+        pending = self.end - self.start
+        if pending <= len(self.buffer) // 2 and self.start >= pending:
+            # Переносим в начало только недочитанный хвост последнего кадра
+            # (области не пересекаются, копирование внутри буфера безопасно)
+            buffer = self.buffer
+        else:
+            # Крупный кадр не помещается: увеличиваем буфер
+            size = len(self.buffer) * 2 if pending > len(self.buffer) // 2 else len(self.buffer)
+            buffer = bytearray(size)
+        buffer[:pending] = self.view[self.start:self.end]
+        self.bytes_copied += pending
+        self.metrics.count('bytes_copied', self.labels, pending)
+        if buffer is not self.buffer:
+            self.buffer, self.view = buffer, memoryview(buffer)
+        self.start, self.end = 0, pending
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self.bytes_received += nbytes
+        self.metrics.count('bytes_received', self.labels, nbytes)
+        self._process_frames()
+
+    def _process_frames(self):
+        if self.jobs_task is not None:
+            return  # Кадры разберём после завершения заданий
+        jobs = []
+        try:
+            while True:
+                frame = self._parse_frame()
+                if frame is None:
+                    break
+                frame_size, session_id, code, header, payload = frame
+                if self.server.offloads(code):
+                    # Подряд идущие кадры данных уходят в исполнитель одной пачкой
+                    jobs.append(self.server.handle_frame_async(session_id, code, header, payload))
+                elif jobs:
+                    break  # Остальные кадры обрабатываются после ответов на предыдущие
+                else:
+                    started_at = time.perf_counter()
+                    self.server.handle_frame(session_id, code, header, payload, self.transport)
+                    self.metrics.observe('frame_seconds', self.labels, time.perf_counter() - started_at)
+                self.start += frame_size
+                self.frames_served += 1
+                self.metrics.count('frames_received', self.labels)
+        except Exception as e:
+            for job in jobs:
+                job.close()
+            logging.error(f"Ошибка при обработке клиента: {e}")  # Логирование ошибок
+            self.transport.close()
+            return
+        if jobs:
+            self.transport.pause_reading()
+            self.jobs_task = asyncio.create_task(self._finish_jobs(jobs, time.perf_counter()))
+        elif self.start == self.end:
+            self.start = self.end = 0  # Все кадры разобраны: буфер снова свободен целиком
+
+    async def _finish_jobs(self, jobs, started_at):
+        try:
+            replies = await asyncio.gather(*jobs)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке клиента: {e}")  # Логирование ошибок
+            self.transport.close()
+            return
+        if self.transport.is_closing():
+            return
+        for reply in replies:
+            self.transport.writelines(reply)  # Ответы в порядке кадров
+        # Время от разбора кадра до ответа: у кадров одной пачки оно общее
+        elapsed = time.perf_counter() - started_at
+        for _ in jobs:
+            self.metrics.observe('frame_seconds', self.labels, elapsed)
+        self.jobs_task = None
+        if not self.writing_paused:
+            self.transport.resume_reading()
+        self._process_frames()  # Кадры, принятые до приостановки чтения
+
+    def _parse_frame(self):
+        # Возвращает разобранный кадр или None, если кадр ещё не пришёл целиком
+        available = self.end - self.start
+        if available < FRAME_HEADER.size:
+            return None
+        session_id, code = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        # У сегмента v1 вместо кода номер сегмента, а после него SHA-256
+        extra = CONTROL_HEADER_SIZES.get(code, LEGACY_CHECKSUM_SIZE)
+        length_offset = FRAME_HEADER.size + extra
+        if available < length_offset + DATA_LENGTH.size:
+            return None
+        data_length = DATA_LENGTH.unpack_from(self.buffer, self.start + length_offset)[0]
+        frame_size = length_offset + DATA_LENGTH.size + data_length
+        if available < frame_size:
+            return None
+
+        header = self.view[self.start + FRAME_HEADER.size:self.start + length_offset]
+        payload = self.view[self.start + length_offset + DATA_LENGTH.size:self.start + frame_size]
+        self.sessions.add(session_id)
+        return frame_size, session_id, code, header, payload
+
+    def pause_writing(self):
+        # Клиент не успевает читать ответы: перестаём принимать от него кадры
+        self.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.jobs_task is None:
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.server.connections[self.channel_name].discard(self)
+        elapsed = time.time() - self.started_at  # Время обслуживания соединения
+        copied = self.bytes_copied / self.bytes_received if self.bytes_received else 0.0
+        logging.info(
+            f"Соединение закрыто. Кадров: {self.frames_served}, сессий: {len(self.sessions)}, "
+            f"скопировано {copied:.3f} байт на принятый байт, время: {elapsed:.2f} сек")
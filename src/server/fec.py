@@ -0,0 +1,61 @@
+# fec.py
+# Восстановление сегментов по чётности: для каждого незавершённого блока сервер накапливает
+# XOR полученных зашифрованных сегментов, поэтому сами сегменты хранить не нужно
+from protocol.fec import xor_segments
+
+
+class ParityBlock:
+    def __init__(self, count):
+        self.count = count  # Число сегментов блока (последний блок сессии может быть короче)
+        self.received = set()  # Номера полученных сегментов блока
+        self.value = 0  # XOR полученных сегментов
+        self.lengths = 0  # XOR их длин
+        self.parity = None  # XOR всех сегментов блока из кадра чётности
+        self.parity_lengths = 0
+
+
+class ParityBlocks:
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.blocks = {}  # Первый сегмент блока -> ParityBlock
+
+    def add_segment(self, segment_number, data):
+        # Возвращает (номер, зашифрованный сегмент), если благодаря этому сегменту восстановлен другой
+        start = segment_number - segment_number % self.block_size
+        block = self.blocks.setdefault(start, ParityBlock(self.block_size))
+        if segment_number in block.received:
+            return None
+        block.received.add(segment_number)
+        block.value ^= xor_segments([data])
+        block.lengths ^= len(data)
+        return self._recover(start, block)
+
+    def add_parity(self, start, count, lengths, data):
+        block = self.blocks.setdefault(start, ParityBlock(count))
+        block.count = count
+        block.parity = xor_segments([data])
+        block.parity_lengths = lengths
+        return self._recover(start, block)
+
+    def prune(self, contiguous):
+        # Удаляет блоки, все сегменты которых уже получены: их сегменты могли прийти в другие рабочие
+        # процессы, и тогда блок здесь никогда не соберётся целиком
+        while self.blocks:
+            start = next(iter(self.blocks))
+            if start + self.block_size > contiguous:
+                break
+            del self.blocks[start]
+
+    def _recover(self, start, block):
+        if len(block.received) >= block.count:
+            del self.blocks[start]  # Блок получен целиком, чётность не понадобилась
+            return None
+        if block.parity is None or len(block.received) < block.count - 1:
+            return None
+        del self.blocks[start]
+        # Не хватает ровно одного сегмента: он равен XOR чётности и остальных сегментов блока
+        missing = next(n for n in range(start, start + block.count) if n not in block.received)
+        try:
+            return missing, (block.value ^ block.parity).to_bytes(block.lengths ^ block.parity_lengths, 'little')
+        except OverflowError:
+            return None  # Чётность не согласуется с полученными сегментами
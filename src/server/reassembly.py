@@ -0,0 +1,270 @@
+# reassembly.py
+# Сборка сессии прямо в файле: каждый сегмент записывается по своему смещению сразу после проверки
+import mmap
+import os
+import struct
+import time
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+from protocol import CIPHER_CBC
+from protocol.compression import decompress_chunks
+
+LEGACY_SEGMENT_SIZE = 1024  # Размер сегмента клиентов v1, не передающих его в KEY
+FINALIZE_CHUNK_SIZE = 64 * 1024  # Порция потоковой расшифровки CBC при завершении
+
+
+class ReceivedSegments:
+    # Полученные сегменты сессии, которую собирает один процесс
+    def __init__(self):
+        self.contiguous = 0  # Количество сегментов, полученных подряд с начала
+        # Полученные сегменты за пределами непрерывного префикса: их не больше окна клиента
+        self.out_of_order = set()
+
+    def __contains__(self, segment_number):
+        return segment_number < self.contiguous or segment_number in self.out_of_order
+
+    def add(self, segment_number):
+        if segment_number < self.contiguous:
+            return  # Повторная передача уже полученного сегмента
+        self.out_of_order.add(segment_number)
+        while self.contiguous in self.out_of_order:
+            self.out_of_order.remove(self.contiguous)
+            self.contiguous += 1
+
+    def close(self):
+        pass
+
+
+class ReceivedMap:
+    # Полученные сегменты сессии, общие для рабочих процессов сервера: файл с байтом на сегмент,
+    # отображённый в память. Каждый процесс пишет только байты своих сегментов, поэтому блокировки не нужны
+    HEADER = struct.Struct('!Q')  # Конец неполного последнего сегмента, если он уже получен
+    INITIAL_SEGMENTS = 64 * 1024
+
+    def __init__(self, path, create):
+        self.fd = open_session_file(path, create)
+        self.map = None
+        self.known = 0  # Сегменты до known получены: поиск первого неполученного начинается с него
+        self._remap(self.HEADER.size + self.INITIAL_SEGMENTS)
+
+    def _remap(self, size=0):
+        # Файл только растёт (posix_fallocate его не уменьшает), а каждый процесс отображает его целиком
+        if size > os.fstat(self.fd).st_size:
+            os.posix_fallocate(self.fd, 0, size)
+        size = os.fstat(self.fd).st_size
+        if self.map is None or size > len(self.map):
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.fd, size)
+
+    def __contains__(self, segment_number):
+        index = self.HEADER.size + segment_number
+        if index >= len(self.map):
+            self._remap()  # Карту мог расширить другой процесс
+        return index < len(self.map) and self.map[index] != 0
+
+    def add(self, segment_number):
+        index = self.HEADER.size + segment_number
+        if index >= len(self.map):
+            self._remap(max(2 * len(self.map), index + 1))
+        self.map[index] = 1
+
+    @property
+    def contiguous(self):
+        position = self.map.find(b'\x00', self.HEADER.size + self.known)
+        if position < 0:
+            self._remap()
+            position = self.map.find(b'\x00', self.HEADER.size + self.known)
+        self.known = (position if position >= 0 else len(self.map)) - self.HEADER.size
+        return self.known
+
+    @property
+    def size(self):
+        return self.HEADER.unpack_from(self.map)[0]
+
+    @size.setter
+    def size(self, value):
+        self.HEADER.pack_into(self.map, 0, value)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def open_session_file(path, create):
+    # Файлы общей сессии создаются заново: прежние файлы с тем же именем могут быть ещё открыты
+    # другими процессами. Присоединяющийся процесс открывает уже созданные файлы
+    if not create:
+        return os.open(path, os.O_RDWR)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+
+
+def read_session_key(path):
+    # Параметры общей сессии (полезная нагрузка её KEY) или None, если их ещё не записали
+    try:
+        with open(path + '.key', 'rb') as key_file:
+            payload = key_file.read()
+    except FileNotFoundError:
+        return None
+    return payload if len(payload) >= 32 else None
+
+
+class SessionFile:
+    def __init__(self, path, key, iv, cipher, segment_size=None, shared=False, create=True, compression=None):
+        self.path = path  # Итоговый файл сессии
+        self.part_path = path + '.part'  # Файл, в котором идёт сборка
+        self.key_path = path + '.key'  # Параметры общей сессии (см. AggregatedServer.open_shared_file)
+        self.key = key
+        self.iv = iv
+        self.cipher = cipher
+        self.segment_size = segment_size or LEGACY_SEGMENT_SIZE
+        # Алгоритм сжатия (protocol.compression): сегменты содержат поток сжатых порций,
+        # который распаковывается при завершении сессии; None — данные без сжатия
+        self.compression = compression
+        self.size = 0  # Размер собранных данных (конец самого дальнего сегмента)
+        # shared — сессию собирают несколько рабочих процессов: сегменты пишутся в общий файл,
+        # а полученные отмечаются в общей карте; create=False — файлы уже создал другой процесс
+        self.shared = shared
+        if not shared:
+            self.received = ReceivedSegments()
+            self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            return
+        self.received = ReceivedMap(path + '.map', create)
+        try:
+            self.fd = open_session_file(self.part_path, create)
+        except OSError:
+            self.received.close()
+            raise
+
+    @property
+    def contiguous(self):
+        return self.received.contiguous
+
+    def write_segment(self, segment_number, data):
+        # Сегменты CTR и GCM приходят уже расшифрованными (protocol.crypto.decrypt_segments),
+        # сегменты CBC пишутся зашифрованными и расшифровываются потоком при завершении
+        offset = segment_number * self.segment_size
+        os.pwrite(self.fd, data, offset)
+        self.size = max(self.size, offset + len(data))
+        if self.shared and len(data) < self.segment_size:
+            self.received.size = offset + len(data)  # Неполным бывает только последний сегмент
+        self.mark_received(segment_number)
+        return self.contiguous
+
+    def preallocate(self, total_segments):
+        # Место под все сегменты выделяется заранее, чтобы запись по смещениям не фрагментировала файл
+        if hasattr(os, 'posix_fallocate') and total_segments:
+            os.posix_fallocate(self.fd, 0, total_segments * self.segment_size)
+
+    def has_segment(self, segment_number):
+        return segment_number in self.received
+
+    def mark_received(self, segment_number):
+        self.received.add(segment_number)
+
+    def idle_time(self):
+        # Сколько секунд в файл сборки не писал ни один процесс
+        return time.time() - os.fstat(self.fd).st_mtime
+
+    def finalize(self, max_size=None):
+        # Возвращает длину расшифрованных (и распакованных) данных или None, если общую сессию уже завершил
+        # другой рабочий процесс; ValueError при ошибке расшифровки или распаковки.
+        # max_size ограничивает объём распакованных данных
+        part_path = self.part_path
+        if self.shared:
+            # FIN может прийти в несколько процессов: завершает тот, кто первым переименовал файл сборки
+            part_path = self.part_path + '.final'
+            try:
+                os.rename(self.part_path, part_path)
+            except FileNotFoundError:
+                self.close()
+                return None
+            # Сегменты сессии получены подряд, полными могут быть все, кроме последнего
+            self.size = self.received.size or self.received.contiguous * self.segment_size
+            _unlink(self.key_path)  # Процессы, не знающие сессию, больше к ней не присоединятся
+            _unlink(self.path + '.map')
+        try:
+            if self.cipher == CIPHER_CBC:
+                self.size = self._decrypt_cbc_in_place()
+            os.ftruncate(self.fd, self.size)
+            if self.compression is not None:
+                self.size = self._decompress(part_path, max_size)
+        except ValueError:
+            self.close()
+            _unlink(part_path)
+            raise
+        self.close()
+        os.replace(part_path, self.path)  # Сессия собрана: достаточно переименовать файл
+        return self.size
+
+    def _decrypt_cbc_in_place(self):
+        if not self.size or self.size % AES.block_size:
+            raise ValueError('длина данных CBC не кратна размеру блока')
+        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)  # Объект хранит сцепление блоков между порциями
+        for offset in range(0, self.size, FINALIZE_CHUNK_SIZE):
+            chunk = os.pread(self.fd, min(FINALIZE_CHUNK_SIZE, self.size - offset), offset)
+            os.pwrite(self.fd, cipher.decrypt(chunk), offset)
+        # Дополнение PKCS#7 находится в последнем блоке
+        last_block = os.pread(self.fd, AES.block_size, self.size - AES.block_size)
+        return self.size - AES.block_size + len(unpad(last_block, AES.block_size))
+
+    def _decompress(self, part_path, max_size):
+        # Порции распаковываются по одной в новый файл, который заменяет файл сборки
+        plain_path = part_path + '.plain'
+        fd = os.open(plain_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        length = 0
+        try:
+            for data in decompress_chunks(self.compression, lambda offset, n: os.pread(self.fd, n, offset), self.size):
+                length += len(data)
+                if max_size is not None and length > max_size:
+                    raise ValueError('распакованные данные превышают допустимый объём сессии')
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+        except ValueError:
+            os.close(fd)
+            _unlink(plain_path)
+            raise
+        os.close(fd)
+        os.replace(plain_path, part_path)
+        return length
+
+    def close(self):
+        # Закрывает файлы сессии, не удаляя их
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.received.close()
+
+    def is_current(self):
+        # Файл сборки общей сессии ещё на месте: его не переименовал завершивший сессию процесс
+        # и не пересоздала новая сессия с тем же идентификатором
+        if not self.shared or self.fd is None:
+            return self.fd is not None
+        try:
+            return os.stat(self.part_path).st_ino == os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            return False  # Сессию завершил другой процесс
+
+    def discard(self):
+        # Общие файлы удаляются, только если они всё ещё принадлежат этой сессии
+        owned = self.is_current() if self.shared else True
+        self.close()
+        if owned:
+            _unlink(self.part_path)
+            if self.shared:
+                _unlink(self.key_path)
+                _unlink(self.path + '.map')
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
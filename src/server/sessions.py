@@ -0,0 +1,123 @@
+# sessions.py
+# Таблица сессий сервера с ограничениями: число сессий, объём данных одной сессии и всех вместе,
+# удаление сессий, по которым долго не приходят кадры
+import asyncio
+import heapq
+import time
+
+CHARGED = 0  # Объём учтён, сегмент можно сохранить
+SESSION_LIMIT = 1  # Превышен объём одной сессии: такие сегменты не будут приняты никогда
+SERVER_BUSY = 2  # Превышен общий объём: сегменты можно прислать позже
+
+ADMITTED = 0  # Сессия создана или KEY повторён по другому каналу
+CONFLICT = 1  # Идентификатор занят сессией с другим ключом
+BUSY = 2  # Сервер не принимает новые сессии
+TOO_LARGE = 3  # Заранее известный объём сессии больше допустимого: повтор бесполезен
+
+
+class SessionManager:
+    def __init__(self, max_sessions=1024, max_session_bytes=1 << 30, max_total_bytes=8 << 30, ttl=60.0):
+        self.max_sessions = max_sessions  # Каждая сессия держит открытый файл
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl = ttl  # Сколько секунд сессия может простаивать без кадров
+        self.sessions = {}  # session_id -> состояние сессии
+        self.total_bytes = 0  # Объём данных всех незавершённых сессий
+        # Куча сроков (deadline, session_id): при обращении к сессии срок обновляется только в её
+        # состоянии, а устаревшая запись в куче переставляется при проверке — O(log n) на сессию за ttl
+        self.deadlines = []
+        # Недавно завершённые сессии: session_id -> срок, до которого помнится завершение, и куча этих сроков.
+        # FIN, повторённый по другому каналу после завершения, получает подтверждение, а FIN сессии,
+        # удалённой по ttl вместе с данными, — отказ
+        self.finished = {}
+        self.finished_deadlines = []
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session['deadline'] = time.monotonic() + self.ttl  # Сессия активна
+        return session
+
+    def open(self, session_id, key, iv, create, reserve=0, limit=None):
+        # Возвращает (статус, сессия); create() возвращает (статус, SessionFile новой сессии или None),
+        # reserve — заранее известный объём сессии, учитываемый сразу. limit — наибольший объём, который
+        # сессия может записать (по умолчанию max_session_bytes): поток сжатых порций бывает чуть длиннее
+        # данных, ограничение которых проверяется при распаковке
+        session = self.get(session_id)
+        if session is not None:
+            if session['file'].key != key or session['file'].iv != iv:
+                return CONFLICT, None
+            return ADMITTED, session  # KEY той же сессии по очередному каналу
+        if reserve > self.max_session_bytes:
+            return TOO_LARGE, None
+        if len(self.sessions) >= self.max_sessions or self.total_bytes + max(reserve, 1) > self.max_total_bytes:
+            return BUSY, None
+        status, session_file = create()
+        if session_file is None:
+            return status, None  # Файлы общей сессии заняты или ещё создаются другим процессом
+        deadline = time.monotonic() + self.ttl
+        session = {
+            'file': session_file, 'total_segments': None, 'parity': None, 'bytes': 0, 'deadline': deadline,
+            'limit': limit or self.max_session_bytes,
+            'lock': asyncio.Lock(),  # Блокировка завершения сессии
+        }
+        self.sessions[session_id] = session
+        heapq.heappush(self.deadlines, (deadline, session_id))
+        self.charge(session, reserve)
+        return ADMITTED, session
+
+    def charge(self, session, end):
+        # Учитывает данные сессии до смещения end (конец сегмента или зарезервированного файла)
+        growth = end - session['bytes']
+        if growth <= 0:
+            return CHARGED
+        if end > session['limit']:
+            return SESSION_LIMIT
+        if self.total_bytes + growth > self.max_total_bytes and session is not next(iter(self.sessions.values())):
+            # Самой старой сессии разрешено превысить общий объём (не больше max_session_bytes):
+            # иначе сессии неизвестного размера, исчерпавшие объём, ждали бы друг друга до удаления по ttl
+            return SERVER_BUSY
+        session['bytes'] = end
+        self.total_bytes += growth
+        return CHARGED
+
+    def remove(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self.total_bytes -= session['bytes']
+        return session
+
+    def finish(self, session_id):
+        # Сессия завершена: запись о ней хранится ttl секунд, поэтому их не больше, чем завершений за ttl
+        deadline = time.monotonic() + self.ttl
+        self.finished[session_id] = deadline
+        heapq.heappush(self.finished_deadlines, (deadline, session_id))
+
+    def is_finished(self, session_id):
+        deadline = self.finished.get(session_id)
+        return deadline is not None and deadline > time.monotonic()
+
+    def expire(self, now=None):
+        # Удаляет из таблицы сессии, простаивающие дольше ttl, и возвращает их
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, session_id = heapq.heappop(self.deadlines)
+            session = self.sessions.get(session_id)
+            if session is None:
+                continue  # Сессия уже завершена
+            if session['deadline'] > now:
+                heapq.heappush(self.deadlines, (session['deadline'], session_id))  # Были новые кадры
+                continue
+            expired.append((session_id, self.remove(session_id)))
+        while self.finished_deadlines and self.finished_deadlines[0][0] <= now:
+            deadline, session_id = heapq.heappop(self.finished_deadlines)
+            if self.finished.get(session_id) == deadline:
+                del self.finished[session_id]  # Иначе сессия с тем же идентификатором завершена ещё раз позже
+        return expired
@@ -0,0 +1,41 @@
+# test_client.py
+# Общие оценки каналов клиента после прерванных передач
+import asyncio
+import os
+
+import pytest
+
+from client import AggregatedClient
+from server import AggregatedServer
+from .test_server import free_channels
+
+
+async def endless(chunk_size=16 * 1024):
+    while True:
+        yield os.urandom(chunk_size)
+        await asyncio.sleep(0)
+
+
+@pytest.mark.parametrize('protocol_version', [1, 2])
+def test_cancelled_transfers_leave_no_queue(tmp_path, protocol_version):
+    # Отправители прерванных передач снимают свои сегменты с очереди каналов: иначе очередь в оценке
+    # общего клиента остаётся навсегда и искажает выбор каналов для следующих сессий
+    async def run():
+        channels = free_channels(2)
+        server = AggregatedServer(channels, storage_dir=str(tmp_path), crypto_executor=None)
+        serving = asyncio.create_task(server.start_servers())
+        await asyncio.sleep(0.1)
+        try:
+            async with AggregatedClient(('127.0.0.1', 0), channels, crypto_executor=None,
+                                        protocol_version=protocol_version) as client:
+                for _ in range(3):
+                    with pytest.raises(asyncio.TimeoutError):
+                        await asyncio.wait_for(client.send_stream(endless()), 0.3)
+                return dict(client.estimator.in_flight), {name: window.free for name, window in client.windows.items()}
+        finally:
+            serving.cancel()
+            await asyncio.gather(serving, return_exceptions=True)
+
+    in_flight, free = asyncio.run(run())
+    assert in_flight == {'Channel1': 0, 'Channel2': 0}
+    assert free == {'Channel1': 8, 'Channel2': 8}
@@ -0,0 +1,79 @@
+# test_compression.py
+# Сжатие потока порциями и ограничения распаковки на сервере
+import os
+import zlib
+
+import pytest
+
+from protocol.compression import (CHUNK_COMPRESSED, CHUNK_HEADER, CHUNK_STORED, COMPRESSION_CHUNK_SIZE,
+                                  COMPRESSION_LZMA, COMPRESSION_ZLIB, compress_chunks, decompress_chunks,
+                                  max_compressed_size)
+
+
+TRAILING = zlib.compress(b'a') + b'tail'
+
+
+def decompress(codec, stream):
+    return b''.join(decompress_chunks(codec, lambda offset, length: stream[offset:offset + length], len(stream)))
+
+
+@pytest.mark.parametrize('codec', [COMPRESSION_ZLIB, COMPRESSION_LZMA])
+def test_round_trip(codec):
+    chunks = [b'abc' * 20000, b'x' * 100]
+    stream = b''.join(compress_chunks(codec, None if codec == COMPRESSION_ZLIB else 1, chunks))
+    assert len(stream) < sum(map(len, chunks))
+    assert decompress(codec, stream) == b''.join(chunks)
+
+
+def test_incompressible_chunk_is_stored():
+    # Порция ровно COMPRESSION_CHUNK_SIZE байт случайных данных передаётся как есть
+    chunk = os.urandom(COMPRESSION_CHUNK_SIZE)
+    (framed,) = compress_chunks(COMPRESSION_ZLIB, None, [chunk])
+    assert CHUNK_HEADER.unpack_from(framed) == (CHUNK_STORED, COMPRESSION_CHUNK_SIZE)
+    assert len(framed) == max_compressed_size(len(chunk))
+    assert decompress(COMPRESSION_ZLIB, framed) == chunk
+
+
+def test_full_size_compressed_chunk():
+    # Сжатая порция распаковывается ровно в COMPRESSION_CHUNK_SIZE байт: это ещё допустимо
+    chunk = b'abcd' * (COMPRESSION_CHUNK_SIZE // 4)
+    (framed,) = compress_chunks(COMPRESSION_ZLIB, None, [chunk])
+    assert CHUNK_HEADER.unpack_from(framed)[0] == CHUNK_COMPRESSED
+    assert decompress(COMPRESSION_ZLIB, framed) == chunk
+
+
+def test_low_entropy_chunk_stored_when_not_smaller():
+    # Сжатие не уменьшило порцию: она передаётся как есть, поток не длиннее max_compressed_size
+    chunk = b'ab'
+    (framed,) = compress_chunks(COMPRESSION_ZLIB, None, [chunk])
+    assert framed == CHUNK_HEADER.pack(CHUNK_STORED, len(chunk)) + chunk
+
+
+def test_oversized_chunk_rejected():
+    stream = CHUNK_HEADER.pack(CHUNK_STORED, COMPRESSION_CHUNK_SIZE + 1) + bytes(COMPRESSION_CHUNK_SIZE + 1)
+    with pytest.raises(ValueError):
+        decompress(COMPRESSION_ZLIB, stream)
+
+
+def test_decompression_bomb_rejected():
+    # Порция, распаковывающаяся больше чем в COMPRESSION_CHUNK_SIZE байт
+    data = zlib.compress(bytes(COMPRESSION_CHUNK_SIZE + 1))
+    with pytest.raises(ValueError):
+        decompress(COMPRESSION_ZLIB, CHUNK_HEADER.pack(CHUNK_COMPRESSED, len(data)) + data)
+
+
+@pytest.mark.parametrize('stream', [
+    CHUNK_HEADER.pack(7, 1) + b'a',  # Неизвестный признак порции
+    CHUNK_HEADER.pack(CHUNK_STORED, 10) + b'short',  # Порция обрезана
+    CHUNK_HEADER.pack(CHUNK_STORED, 1)[:-1],  # Заголовок обрезан
+    CHUNK_HEADER.pack(CHUNK_COMPRESSED, 5) + b'junk!',  # Не сжатые данные
+    CHUNK_HEADER.pack(CHUNK_COMPRESSED, len(TRAILING)) + TRAILING,  # Данные после конца сжатого потока
+])
+def test_invalid_stream_rejected(stream):
+    with pytest.raises(ValueError):
+        decompress(COMPRESSION_ZLIB, stream)
+
+
+def test_unknown_codec_rejected():
+    with pytest.raises(ValueError):
+        compress_chunks(99, None, [b'a' * 1000])
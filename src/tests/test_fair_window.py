@@ -0,0 +1,70 @@
+# test_fair_window.py
+# Общее окно канала: места делятся между сессиями по кругу, отменённые ожидания не теряют места
+import asyncio
+
+from client.session import FairWindow
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_round_robin_between_sessions():
+    async def run():
+        window = FairWindow(1)
+        await window.acquire('big')
+        order = []
+
+        async def sender(session_id):
+            async with window.slot(session_id):
+                order.append(session_id)
+
+        tasks = [asyncio.create_task(sender('big')) for _ in range(3)]
+        await settle()
+        tasks.append(asyncio.create_task(sender('small')))
+        await settle()
+        window.release()
+        await asyncio.gather(*tasks)
+        return order, window
+
+    order, window = asyncio.run(run())
+    assert order == ['big', 'small', 'big', 'big']
+    assert window.free == 1 and not window.waiters
+
+
+def test_cancelled_waiter_does_not_take_slot():
+    async def run():
+        window = FairWindow(1)
+        await window.acquire(1)
+        waiter = asyncio.create_task(window.acquire(2))
+        other = asyncio.create_task(window.acquire(3))
+        await settle()
+        waiter.cancel()
+        await settle()
+        window.release()
+        await other  # Место получает следующий ожидающий, а не отменённый
+        cancelled = waiter.cancelled()
+        window.release()
+        return cancelled, window
+
+    cancelled, window = asyncio.run(run())
+    assert cancelled
+    assert window.free == 1 and not window.waiters
+
+
+def test_waiter_cancelled_after_grant_releases_slot():
+    async def run():
+        window = FairWindow(1)
+        await window.acquire(1)
+        waiter = asyncio.create_task(window.acquire(2))
+        await settle()
+        window.release()  # Место выделено ожидающему, но он ещё не возобновился
+        waiter.cancel()
+        await settle()
+        return waiter.cancelled(), window
+
+    cancelled, window = asyncio.run(run())
+    assert cancelled
+    assert window.free == 1 and not window.waiters
+
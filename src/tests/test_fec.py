@@ -0,0 +1,82 @@
+# test_fec.py
+# Восстановление сегментов по чётности на сервере
+import os
+
+from protocol import FEC_PARITY
+from protocol.fec import encode_parity
+from server.fec import ParityBlocks
+
+KEY = bytes(16)
+
+
+def parity_record(first, block_size, segments):
+    # Запись чётности разбирается так же, как на сервере: (count, lengths) и XOR сегментов
+    (data,), _ = encode_parity(KEY, first, block_size, segments)
+    count, lengths = FEC_PARITY.unpack_from(data)
+    return count, lengths, data[FEC_PARITY.size:]
+
+
+def test_recovers_missing_segment():
+    segments = [os.urandom(100) for _ in range(4)]
+    blocks = ParityBlocks(4)
+    for number in (0, 1, 3):
+        assert blocks.add_segment(number, segments[number]) is None
+    assert blocks.add_parity(0, *parity_record(0, 4, segments)) == (2, segments[2])
+    assert not blocks.blocks
+
+
+def test_short_last_block():
+    # Последний блок сессии: 2 сегмента из 4, последний сегмент короче остальных
+    segments = [os.urandom(100), os.urandom(37)]
+    blocks = ParityBlocks(4)
+    count, lengths, data = parity_record(8, 4, segments)
+    assert count == 2
+    assert blocks.add_parity(8, count, lengths, data) is None
+    assert blocks.add_segment(8, segments[0]) == (9, segments[1])
+    assert not blocks.blocks
+
+
+def test_short_segment_with_trailing_zeros():
+    # Длина восстанавливается по XOR длин, а не по значению: нули в конце сегмента не теряются
+    segments = [os.urandom(64), os.urandom(20) + bytes(12)]
+    blocks = ParityBlocks(2)
+    blocks.add_segment(0, segments[0])
+    assert blocks.add_parity(0, *parity_record(0, 2, segments)) == (1, segments[1])
+
+
+def test_complete_block_needs_no_parity():
+    segments = [os.urandom(50) for _ in range(3)]
+    blocks = ParityBlocks(3)
+    for number, segment in enumerate(segments):
+        assert blocks.add_segment(number, segment) is None
+    assert not blocks.blocks
+    assert blocks.add_segment(1, segments[1]) is None
+
+
+def test_corrupt_and_missing_segment():
+    # Сегмент 1 повреждён (не прошёл проверку тега и не учтён в блоке), сегмент 2 потерян: по чётности
+    # восстанавливается только один недостающий сегмент, блок ждёт повтора повреждённого
+    segments = [os.urandom(80) for _ in range(4)]
+    blocks = ParityBlocks(4)
+    blocks.add_segment(0, segments[0])
+    blocks.add_segment(3, segments[3])
+    assert blocks.add_parity(0, *parity_record(0, 4, segments)) is None
+    assert blocks.add_segment(1, segments[1]) == (2, segments[2])
+
+
+def test_inconsistent_parity_is_ignored():
+    # Чётность, не согласующаяся с сегментами (неверный XOR длин), не даёт ложного сегмента
+    segments = [os.urandom(80) for _ in range(2)]
+    blocks = ParityBlocks(2)
+    blocks.add_segment(0, segments[0])
+    count, lengths, data = parity_record(0, 2, segments)
+    assert blocks.add_parity(0, count, lengths ^ 80 ^ 1, data) is None
+    assert not blocks.blocks
+
+
+def test_prune_drops_received_blocks():
+    blocks = ParityBlocks(4)
+    blocks.add_segment(1, b'a')
+    blocks.add_segment(5, b'b')
+    blocks.prune(4)
+    assert list(blocks.blocks) == [4]
@@ -0,0 +1,95 @@
+# test_scheduler.py
+# Доли каналов в расписании и оценки каналов
+import time
+
+from client.scheduler import (ChannelEstimator, DeficitRoundRobinScheduler, EarliestCompletionScheduler,
+                              WeightedRoundRobinScheduler)
+
+CHANNELS = [{'name': 'fast'}, {'name': 'slow'}]
+
+
+def estimator(fast=3e6, slow=1e6, fast_latency=0.01, slow_latency=0.01):
+    estimator = ChannelEstimator(CHANNELS)
+    estimator.update('fast', fast_latency, fast)
+    estimator.update('slow', slow_latency, slow)
+    return estimator
+
+
+def shares(scheduler, count, nbytes=1000):
+    selected = {ch['name']: 0 for ch in CHANNELS}
+    for _ in range(count):
+        selected[scheduler.select(nbytes)['name']] += 1
+    return selected
+
+
+def test_wrr_shares_follow_bandwidth():
+    assert shares(WeightedRoundRobinScheduler(CHANNELS, estimator()), 64) == {'fast': 48, 'slow': 16}
+
+
+def test_wrr_interleaves_channels():
+    scheduler = WeightedRoundRobinScheduler(CHANNELS, estimator(), slots=4)
+    assert [scheduler.select(1000)['name'] for _ in range(4)] == ['fast', 'fast', 'slow', 'fast']
+
+
+def test_min_share():
+    scheduler = WeightedRoundRobinScheduler(CHANNELS, estimator(fast=1e8, slow=1e6))
+    weights = scheduler.weights()
+    assert abs(weights[1] - 0.05 / (1e8 / 1.01e8 + 0.05)) < 1e-9
+    assert shares(scheduler, 64)['slow'] == 3
+
+
+def test_drr_shares_follow_bandwidth():
+    selected = shares(DeficitRoundRobinScheduler(CHANNELS, estimator()), 4000)
+    assert abs(selected['fast'] / 4000 - 0.75) < 0.02
+
+
+def test_unmeasured_channel_gets_average():
+    estimator = ChannelEstimator(CHANNELS)
+    estimator.update('fast', 0.01, 2e6)
+    assert estimator.capacities() == {'fast': 2e6, 'slow': 2e6}
+    estimator.update('slow', 0.01, 1e6)  # Новый замер сбрасывает сохранённые оценки
+    assert estimator.capacities() == {'fast': 2e6, 'slow': 1e6}
+
+
+def test_backlogged_channel_is_bypassed():
+    estimator_ = estimator(fast=1e6, slow=2.5e5, slow_latency=0.04)
+    scheduler = WeightedRoundRobinScheduler(CHANNELS, estimator_)
+    slow = CHANNELS[1]
+    assert scheduler.unless_backlogged(slow, 1000) is slow  # Опоздание меньше времени обращения
+    estimator_.assign('slow', 50000)
+    assert scheduler.unless_backlogged(slow, 1000) is CHANNELS[0]
+
+
+def test_ecf_accounts_for_queue():
+    estimator_ = estimator()
+    scheduler = EarliestCompletionScheduler(CHANNELS, estimator_)
+    assert scheduler.select(1000)['name'] == 'fast'
+    estimator_.assign('fast', 100000)
+    assert scheduler.select(1000)['name'] == 'slow'
+
+
+def ack(estimator, in_flight, nbytes=1000, latency=0.1):
+    # Подтверждение сегмента, отправленного latency секунд назад при in_flight байтах в канале
+    estimator.assign('fast', nbytes)
+    snapshot = estimator.delivered['fast'], time.monotonic() - latency, in_flight
+    estimator.on_ack('fast', snapshot, nbytes)
+
+
+def test_app_limited_sample_does_not_lower_bandwidth():
+    # Окно канала 1e6 * 0.01 = 10000 байт: при 1000 байтах в пути замер скорости занижен нагрузкой
+    estimator_ = estimator(fast=1e6)
+    ack(estimator_, in_flight=1000)
+    assert estimator_.states['fast']['bandwidth'] == 1e6
+    assert estimator_.states['fast']['samples'] == 2  # Задержка при этом учтена
+    ack(estimator_, in_flight=20000)
+    assert estimator_.states['fast']['bandwidth'] < 1e6
+
+
+def test_base_latency_is_windowed_minimum():
+    estimator_ = ChannelEstimator(CHANNELS, base_window=10.0)
+    estimator_.update('fast', 0.02, 1e6)
+    estimator_.update('fast', 0.5, 1e6)
+    assert estimator_.states['fast']['base_latency'] == 0.02
+    estimator_.states['fast']['base_at'] -= 11.0  # Минимум устарел
+    estimator_.update('fast', 0.5, 1e6)
+    assert estimator_.states['fast']['base_latency'] == 0.5
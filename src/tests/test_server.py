@@ -0,0 +1,51 @@
+# test_server.py
+# Завершение сессий сервером: FIN удалённой по ttl сессии не подтверждается
+import asyncio
+import os
+import socket
+
+import pytest
+
+from client import AggregatedClient
+from server import AggregatedServer
+
+
+def free_channels(count):
+    channels = []
+    for i in range(count):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            channels.append({'name': f'Channel{i + 1}', 'host': '127.0.0.1', 'port': sock.getsockname()[1]})
+    return channels
+
+
+async def transfer(storage_dir, stream, session_ttl=60.0):
+    channels = free_channels(2)
+    server = AggregatedServer(channels, storage_dir=str(storage_dir), crypto_executor=None, session_ttl=session_ttl)
+    serving = asyncio.create_task(server.start_servers())
+    await asyncio.sleep(0.1)
+    try:
+        async with AggregatedClient(('127.0.0.1', 0), channels, crypto_executor=None) as client:
+            return await client.send_stream(stream)
+    finally:
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+
+async def chunks(data, stall=0.0):
+    yield data
+    await asyncio.sleep(stall)  # Источник замолкает после последней порции
+
+
+def test_completed_session(tmp_path):
+    data = os.urandom(48 * 1024)
+    session_id = asyncio.run(transfer(tmp_path, chunks(data)))
+    assert (tmp_path / f'session_{session_id}.dat').read_bytes() == data
+
+
+def test_fin_after_eviction_fails(tmp_path):
+    # Все сегменты (целые кадры по batch_size) доставлены, но источник молчит, и сервер удаляет сессию
+    # по ttl вместе с данными: FIN получает отказ, и передача завершается ошибкой, а не возвратом идентификатора
+    with pytest.raises(ConnectionError):
+        asyncio.run(transfer(tmp_path, chunks(os.urandom(48 * 1024), stall=1.0), session_ttl=0.4))
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,118 @@
+# test_sessions.py
+# Ограничения таблицы сессий сервера и удаление простаивающих сессий
+import pytest
+
+from server import sessions
+from server.sessions import (ADMITTED, BUSY, CHARGED, CONFLICT, SERVER_BUSY, SESSION_LIMIT, TOO_LARGE,
+                             SessionManager)
+
+
+class SessionFile:
+    def __init__(self, key=b'k', iv=b'i'):
+        self.key = key
+        self.iv = iv
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessions.time, 'monotonic', clock)
+    return clock
+
+
+def open_session(manager, session_id, reserve=0, key=b'k'):
+    return manager.open(session_id, key, b'i', lambda: (ADMITTED, SessionFile(key)), reserve)
+
+
+def test_open_limits():
+    manager = SessionManager(max_sessions=2, max_session_bytes=100, max_total_bytes=150)
+    assert open_session(manager, 1, reserve=101) == (TOO_LARGE, None)
+    assert open_session(manager, 1, reserve=100)[0] == ADMITTED
+    assert open_session(manager, 1, key=b'x') == (CONFLICT, None)
+    assert open_session(manager, 2, reserve=60) == (BUSY, None)  # Резерв не помещается в общий объём
+    assert open_session(manager, 2, reserve=50)[0] == ADMITTED
+    assert open_session(manager, 3) == (BUSY, None)
+    assert manager.total_bytes == 150
+
+
+def test_charge_limits():
+    manager = SessionManager(max_session_bytes=100, max_total_bytes=150)
+    _, first = open_session(manager, 1)
+    _, second = open_session(manager, 2)
+    assert manager.charge(second, 60) == CHARGED
+    assert manager.charge(second, 40) == CHARGED  # Сегмент внутри уже учтённого объёма
+    assert manager.charge(second, 101) == SESSION_LIMIT
+    assert manager.charge(first, 100) == CHARGED  # Самой старой сессии разрешено превысить общий объём
+    assert manager.charge(second, 70) == SERVER_BUSY
+    assert manager.total_bytes == 160
+    manager.remove(1)
+    assert manager.charge(second, 70) == CHARGED
+    assert manager.total_bytes == 70
+
+
+def test_charge_own_limit():
+    # Поток сжатых порций может быть длиннее max_session_bytes не больше чем на заголовки порций
+    manager = SessionManager(max_session_bytes=100)
+    _, session = manager.open(1, b'k', b'i', lambda: (ADMITTED, SessionFile()), limit=110)
+    assert manager.charge(session, 110) == CHARGED
+    assert manager.charge(session, 111) == SESSION_LIMIT
+
+
+def test_expire_idle_sessions(clock):
+    manager = SessionManager(ttl=10.0)
+    open_session(manager, 1)
+    clock.now += 5
+    open_session(manager, 2)
+    clock.now += 5
+    assert [session_id for session_id, _ in manager.expire()] == [1]
+    assert 2 in manager and 1 not in manager
+    clock.now += 5
+    assert [session_id for session_id, _ in manager.expire()] == [2]
+    assert not manager.deadlines
+
+
+def test_expire_pushes_back_active_session(clock):
+    # Обращение к сессии обновляет срок только в её состоянии: устаревшая запись кучи переставляется
+    manager = SessionManager(ttl=10.0)
+    open_session(manager, 1, reserve=30)
+    clock.now += 8
+    assert manager.get(1) is not None
+    clock.now += 2
+    assert manager.expire() == []
+    assert manager.deadlines == [(108.0 + 10.0, 1)]
+    clock.now += 8
+    expired = manager.expire()
+    assert [session_id for session_id, _ in expired] == [1]
+    assert manager.total_bytes == 0
+
+
+def test_expire_skips_removed_sessions(clock):
+    manager = SessionManager(ttl=10.0)
+    open_session(manager, 1)
+    manager.remove(1)
+    clock.now += 10
+    assert manager.expire() == []
+    assert not manager.deadlines
+
+
+def test_finished_sessions_expire(clock):
+    manager = SessionManager(ttl=10.0)
+    manager.finish(1)
+    clock.now += 5
+    manager.finish(2)
+    assert manager.is_finished(1) and manager.is_finished(2) and not manager.is_finished(3)
+    clock.now += 5
+    manager.expire()
+    assert not manager.is_finished(1) and manager.is_finished(2)
+    assert list(manager.finished) == [2]
+    clock.now += 5
+    manager.expire()
+    assert not manager.finished and not manager.finished_deadlines